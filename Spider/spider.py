@@ -4,6 +4,7 @@ from operator import invert
 
 import requests
 import os
+import sys
 import json
 from urllib.parse import urljoin, urlparse
 from bs4 import BeautifulSoup
@@ -13,6 +14,10 @@ import datetime
 from utils.DBHelper import DBHelper
 import re
 from unidecode import unidecode
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+from corpus_stats import calculate_corpus_stats, save_corpus_stats
+from index_generation import bump_generation
+from document_cards import linked_documents, invalidate_cards
 #to ignore warning
 import shutup
 shutup.please()
@@ -54,7 +59,8 @@ class WebSpider:
         self.linkageChild= {}
         self.term_hash={}
         self.invert_term={}
-        self.forward_index=[]
+        self.positional_index={}
+        self.token_offsets={}
         os.makedirs(data_dir, exist_ok=True)
 
         self.load_index()
@@ -146,6 +152,21 @@ class WebSpider:
         if not word_counts:
             return 0
         return max(word_counts.values())
+    def tokenize(self, text):
+        """
+        Split the text into index tokens, same as unidecode(text).lower().split(),
+        and keep the character offset (in the original text) of the word each token comes from
+        :param text:
+        :return: tokens, offsets
+        """
+        tokens = []
+        offsets = []
+        for match in re.finditer(r'\S+', text):
+            for token in unidecode(match.group()).lower().split():
+                tokens.append(token)
+                offsets.append(match.start())
+        return tokens, offsets
+
     def crawl(self):
         self.queue.append(self.start_url)
         count = 0
@@ -193,10 +214,13 @@ class WebSpider:
             else:
                 page_id = self.dBHelper.get_page_id(current_url)
 
-            tmp= unidecode(doc['content']).lower()
-            tmp = tmp.split()
+            tmp, offsets = self.tokenize(doc['content'])
             self.invert_term[page_id] = Counter(tmp)
-            self.forward_index.extend([(position+1,page_id,term) for position,term in enumerate(tmp)])
+            self.token_offsets[page_id] = offsets
+            term_positions = defaultdict(list)
+            for position,term in enumerate(tmp):
+                term_positions[term].append(position+1)
+            self.positional_index[page_id] = term_positions
             term_set = set(tmp)
             for term in term_set:
                 if not self.term_hash.get(term,False):
@@ -225,7 +249,16 @@ class WebSpider:
         self.dBHelper.add_term(self.term_hash)
         term2id = self.dBHelper.get_all_term()
         self.dBHelper.add_inverted_index(self.invert_term,term2id)
-        self.dBHelper.add_forward_index(self.forward_index,term2id)
+        self.dBHelper.add_positional_index(self.positional_index,term2id)
+        self.dBHelper.add_token_offsets(self.token_offsets)
+        # Precompute idf, document norms and corpus statistics for the search view
+        save_corpus_stats(calculate_corpus_stats())
+        # Result cards of the fetched documents and of the documents whose link lists show them,
+        # dropped before the bump so no worker reads an old card after seeing the new generation
+        fetched = set(self.linkageParent)
+        invalidate_cards(fetched | linked_documents(fetched))
+        # Cached search results of the previous index are no longer served
+        bump_generation()
 
 
 
@@ -9,6 +9,29 @@ import pymysql
 from MySQLdb.cursors import DictCursor
 
 
+def encode_positions(positions):
+    """
+    encode_positions: delta + varint (LEB128) encoding of token positions.
+    Positions are sorted, the gap to the previous position is written 7 bits per byte, the high bit of a byte
+    marks that more bytes of the same gap follow.
+    Args:
+        positions: iterable of non-negative integers
+
+    Returns: bytes
+
+    """
+    encoded = bytearray()
+    previous = 0
+    for position in sorted(positions):
+        delta = position - previous
+        previous = position
+        while delta >= 0x80:
+            encoded.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        encoded.append(delta)
+    return bytes(encoded)
+
+
 class DBHelper:
     def __init__(self, username="django", host="127.0.0.1", port=3306, database="search_engine", charset="utf8mb4"):
         self.db_config = {
@@ -341,12 +364,39 @@ class DBHelper:
                     "INSERT INTO searchapp_invertedindex (tf, document_id,term_id) VALUES (%s, %s, %s)",
                     data
                 )
-    def add_forward_index(self,data,term2id):
-        data=[(position,document_id,term2id[term]) for position,document_id,term in data]
+    def add_positional_index(self, positional_index, term2id):
+        """
+        add_positional_index: store token positions, one compact blob per (term, document).
+        Args:
+            positional_index: a dictionary document_id -> {term: [positions]}
+            term2id: a dictionary term -> term id
+        """
+        data = [(term2id[term], document_id, encode_positions(positions))
+                for document_id, term_positions in positional_index.items()
+                for term, positions in term_positions.items()]
         with self._get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.executemany(
-                    "INSERT INTO searchapp_forwardindex ( position,document_id,term_id) VALUES (%s, %s, %s)",
+                    """
+                    INSERT INTO searchapp_positionalindex (term_id, document_id, positions) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE positions = VALUES(positions)
+                    """,
                     data
                 )
 
+    def add_token_offsets(self, token_offsets):
+        """
+        add_token_offsets: store where every token of a document starts in its content, used to cut snippets.
+        Args:
+            token_offsets: a dictionary document_id -> [character offset of each token]
+        """
+        data = [(document_id, encode_positions(offsets)) for document_id, offsets in token_offsets.items()]
+        with self._get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    """
+                    INSERT INTO searchapp_tokenoffsets (document_id, offsets) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE offsets = VALUES(offsets)
+                    """,
+                    data
+                )
@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djangoProject.settings")
 
 application = get_asgi_application()
+
+# Load the vague search models and the suggestion index once per worker instead of on the first query
+from django.conf import settings
+from searchApp.utils import vague_searcher, suggestion_index
+
+vague_searcher.warm_up()
+if settings.SUGGESTION_BACKEND == 'index':
+    suggestion_index.get_suggestion_index()
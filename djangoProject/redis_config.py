@@ -65,6 +65,18 @@ CACHES = {
             "MAX_CONNECTIONS": REDIS_CONFIG['default']['max_connections'],
             "COMPRESSOR": REDIS_CONFIG['default']['compressor'],
         }
+    },
+    "document_cards": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": f"redis://{REDIS_CONFIG['default']['host']}:{REDIS_CONFIG['default']['port']}/5",
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "SOCKET_CONNECT_TIMEOUT": REDIS_CONFIG['default']['socket_connect_timeout'],
+            "SOCKET_TIMEOUT": REDIS_CONFIG['default']['socket_timeout'],
+            "RETRY_ON_TIMEOUT": REDIS_CONFIG['default']['retry_on_timeout'],
+            "MAX_CONNECTIONS": REDIS_CONFIG['default']['max_connections'],
+            "COMPRESSOR": REDIS_CONFIG['default']['compressor'],
+        }
     }
 }
 
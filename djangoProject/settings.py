@@ -150,3 +150,11 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 #  Redis configuration
 from .redis_config import CACHES, CACHE_TTL
+
+# Search suggestions: 'redis' (sorted sets shared by all workers, `python manage.py rebuild_autocomplete`),
+# 'index' (per-worker prefix index, scripts/suggestion_index.py) or 'database'.
+# Until the chosen structure is built, suggestions are queried from MySQL.
+SUGGESTION_BACKEND = 'redis'
+
+# Share the decoded positional postings of each term between workers through the default Redis cache
+POSTING_CACHE_REDIS = False
@@ -4,6 +4,8 @@ import pymysql
 import numpy as np
 from tqdm import tqdm
 
+from index_generation import bump_generation
+
 db_config = {
         'host': '127.0.0.1',
         'user': 'django',
@@ -119,4 +121,5 @@ def save_hits_to_db(score_dict):
 
 if __name__ == '__main__':
     result = calculate_hits()
-    save_hits_to_db(result)
\ No newline at end of file
+    save_hits_to_db(result)
+    bump_generation()
\ No newline at end of file
@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+import pymysql
+from sentence_transformers import SentenceTransformer
+
+from clustering import DB_CONFIG, MODEL_CACHE, unit_rows, quantize_embeddings, quantized_scores
+
+# Vocabulary terms used as queries, and neighbours compared per query
+N_QUERIES = 200
+TOP_K = 10
+
+
+def load_reference_embeddings():
+    """float32 unit-norm embeddings of the whole vocabulary, encoded with the saved model"""
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT term FROM searchapp_term ORDER BY id")
+            term_texts = [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    model = SentenceTransformer(MODEL_CACHE)
+    return unit_rows(model.encode(term_texts, show_progress_bar=True))
+
+
+def top_k(scores, k):
+    best = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+    return set(best.tolist())
+
+
+def check_quantization(unit_embeddings, n_queries=N_QUERIES, k=TOP_K, seed=0):
+    """Recall@k of the nearest terms found on each storage type against float32, with memory and query time"""
+    rng = np.random.default_rng(seed)
+    queries = unit_embeddings[rng.choice(len(unit_embeddings), min(n_queries, len(unit_embeddings)), replace=False)]
+    reference = [top_k(unit_embeddings @ q, k) for q in queries]
+
+    report = {}
+    for dtype in ('float32', 'float16', 'int8'):
+        matrix, scales = quantize_embeddings(unit_embeddings, dtype)
+        start = time.perf_counter()
+        found = [top_k(quantized_scores(matrix, scales, q), k) for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries)
+
+        recall = np.mean([len(f & r) / len(r) for f, r in zip(found, reference)])
+        size = matrix.nbytes + (scales.nbytes if scales is not None else 0)
+        report[dtype] = {'recall': float(recall), 'megabytes': size / 2 ** 20, 'ms_per_query': elapsed * 1000}
+    return report
+
+
+if __name__ == '__main__':
+    embeddings = load_reference_embeddings()
+    print(f"{len(embeddings)} terms, recall@{TOP_K} against float32 over {N_QUERIES} queries")
+    for dtype, result in check_quantization(embeddings).items():
+        print(f"{dtype:>8}: recall {result['recall']:.4f}, "
+              f"{result['megabytes']:.1f} MB, {result['ms_per_query']:.2f} ms/query")
@@ -1,3 +1,5 @@
+import glob
+import json
 import os
 
 # from sklearn.cluster._hdbscan import hdbscan
@@ -6,7 +8,8 @@ import joblib
 import numpy as np
 import pymysql
 from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
+
+from index_generation import bump_generation
 
 DB_CONFIG = {
     'host': '127.0.0.1',
@@ -19,6 +22,234 @@ DB_CONFIG = {
 MODEL_NAME = 'all-MiniLM-L6-v2'
 MODEL_CACHE = 'model_cache/'
 CLUSTERER_FILE = 'hdbscan_model.pkl'
+CENTROIDS_FILE = 'cluster_centroids.npz'
+EMBEDDINGS_DIR = 'term_embeddings/'
+MANIFEST_FILE = 'manifest.json'
+# Storage type of the term embeddings read by the workers: 'float32', 'float16', or 'int8' with a scale per row
+EMBEDDING_DTYPE = 'float16'
+ANN_FILE = 'term_ann.npz'
+# Inverted lists probed per query, and k-means iterations used to train the coarse centroids
+ANN_NPROBE = 8
+ANN_TRAIN_ITERATIONS = 10
+ANN_TRAIN_SAMPLES_PER_LIST = 64
+# Terms kept per cluster for query expansion
+CLUSTER_EXPANSION_SIZE = 10
+
+
+def unit_rows(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return (embeddings / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+
+def quantize_embeddings(unit_embeddings, dtype=EMBEDDING_DTYPE):
+    """Returns (stored matrix, per-row scales), scales is None unless dtype is int8"""
+    if dtype == 'int8':
+        scales = np.abs(unit_embeddings).max(axis=1) / 127
+        scales = np.where(scales > 0, scales, 1).astype(np.float32)
+        return np.round(unit_embeddings / scales[:, np.newaxis]).astype(np.int8), scales
+    return unit_embeddings.astype(dtype), None
+
+
+def quantized_scores(matrix, scales, query_embedding, chunk_size=65536):
+    """Dot products of a float32 query with every row of a stored matrix, upcasting one chunk at a time"""
+    query_embedding = query_embedding.astype(np.float32)
+    scores = np.concatenate([
+        matrix[i:i + chunk_size].astype(np.float32, copy=False) @ query_embedding
+        for i in range(0, len(matrix), chunk_size)
+    ]) if len(matrix) else np.empty(0, dtype=np.float32)
+    return scores * scales if scales is not None else scores
+
+
+def save_term_embeddings(term_ids, unit_embeddings, dtype=EMBEDDING_DTYPE):
+    """Write unit-norm term embeddings as a new version, workers only read it once publish_term_embeddings is called"""
+    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+    manifest_path = os.path.join(EMBEDDINGS_DIR, MANIFEST_FILE)
+
+    previous = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    version = previous['version'] + 1 if previous else 1
+
+    manifest = {
+        'version': version,
+        'model': MODEL_NAME,
+        'dim': int(unit_embeddings.shape[1]),
+        'n_terms': len(term_ids),
+        'dtype': dtype,
+        'embeddings': f'embeddings_v{version}.npy',
+        'term_ids': f'term_ids_v{version}.npy',
+        'scales': f'scales_v{version}.npy' if dtype == 'int8' else None,
+    }
+    matrix, scales = quantize_embeddings(unit_embeddings, dtype)
+    np.save(os.path.join(EMBEDDINGS_DIR, manifest['embeddings']), matrix)
+    np.save(os.path.join(EMBEDDINGS_DIR, manifest['term_ids']), np.array(term_ids, dtype=np.int64))
+    if scales is not None:
+        np.save(os.path.join(EMBEDDINGS_DIR, manifest['scales']), scales)
+
+    print(f"Saved term embeddings version {version}")
+    return manifest
+
+
+def publish_term_embeddings(manifest):
+    """Switch searchApp/utils/embedding_store.py readers to a saved version, workers reload their vague search models"""
+    manifest_path = os.path.join(EMBEDDINGS_DIR, MANIFEST_FILE)
+    version = manifest['version']
+
+    # Switch readers to the new version in one step
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    # Keep the previous version for workers that still map it
+    keep = {f'v{version}.npy', f'v{version - 1}.npy'}
+    for path in glob.glob(os.path.join(EMBEDDINGS_DIR, '*_v*.npy')):
+        if not any(path.endswith(suffix) for suffix in keep):
+            os.remove(path)
+
+    print(f"Published term embeddings version {version}")
+
+
+def load_term_embeddings():
+    """Term ids, memory-mapped stored embeddings and their per-row scales (or None) of the latest version"""
+    with open(os.path.join(EMBEDDINGS_DIR, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    term_ids = np.load(os.path.join(EMBEDDINGS_DIR, manifest['term_ids']))
+    matrix = np.load(os.path.join(EMBEDDINGS_DIR, manifest['embeddings']), mmap_mode='r')
+    scales = np.load(os.path.join(EMBEDDINGS_DIR, manifest['scales'])) if manifest.get('scales') else None
+    return term_ids, matrix, scales
+
+
+def nearest_centroids(vectors, centroids, chunk_size=65536):
+    """Index of the most similar centroid of every vector, by chunks to bound memory"""
+    return np.concatenate([
+        np.argmax(vectors[i:i + chunk_size] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), chunk_size)
+    ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+
+def build_ann_index(unit_embeddings, version, seed=0):
+    """
+    IVF index over unit-norm embeddings: spherical k-means centroids, and the embedding rows of every centroid
+    stored contiguously (rows[offsets[c]:offsets[c + 1]] belong to centroid c)
+    """
+    n = len(unit_embeddings)
+    n_lists = max(1, int(np.sqrt(n)))
+    rng = np.random.default_rng(seed)
+
+    # Train the centroids on a sample
+    sample = unit_embeddings[np.sort(rng.choice(n, min(n, n_lists * ANN_TRAIN_SAMPLES_PER_LIST), replace=False))]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(ANN_TRAIN_ITERATIONS):
+        assignment = nearest_centroids(sample, centroids)
+        order = np.argsort(assignment, kind='stable')
+        used, starts = np.unique(assignment[order], return_index=True)
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        # Centroids losing all their vectors keep their previous position
+        centroids = centroids.copy()
+        centroids[used] = unit_rows(sums)
+
+    # Final assignment of every embedding, centroids left without any are dropped so no list is empty
+    used, assignment = np.unique(nearest_centroids(unit_embeddings, centroids), return_inverse=True)
+    centroids = centroids[used]
+    offsets = np.zeros(len(used) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=len(used)), out=offsets[1:])
+    rows = np.argsort(assignment, kind='stable').astype(np.int64)
+
+    return {
+        'version': np.int64(version),
+        'centroids': centroids.astype(np.float32),
+        'offsets': offsets,
+        'rows': rows,
+    }
+
+
+def save_ann_index(index, path=ANN_FILE):
+    np.savez(path, **index)
+    print(f"Saved ANN index with {len(index['centroids'])} lists over {len(index['rows'])} terms")
+
+
+def ann_nearest(index, matrix, scales, query_embedding, nprobe=ANN_NPROBE):
+    """Row of the stored embedding closest to a unit-norm query, probing the nprobe closest inverted lists"""
+    centroid_scores = index['centroids'] @ query_embedding
+    probe = np.argsort(-centroid_scores)[:nprobe]
+    candidates = np.concatenate([index['rows'][index['offsets'][c]:index['offsets'][c + 1]] for c in probe])
+    # Sorted rows keep the reads of a memory-mapped matrix sequential
+    candidates = np.sort(candidates)
+    scores = quantized_scores(matrix[candidates], scales[candidates] if scales is not None else None, query_embedding)
+    return int(candidates[np.argmax(scores)])
+
+
+def build_cluster_centroids(unit_embeddings, clusters, version):
+    """
+    Unit-norm mean embedding of every HDBSCAN cluster (noise excluded), stored as float16, and the lowest
+    similarity between a member and its centroid, below which a query is not assigned to the cluster
+    """
+    in_cluster = np.flatnonzero(clusters >= 0)
+    order = in_cluster[np.argsort(clusters[in_cluster], kind='stable')]
+    labels, starts = np.unique(clusters[order], return_index=True)
+    if len(labels) == 0:
+        centroids = np.empty((0, unit_embeddings.shape[1]), dtype=np.float32)
+        thresholds = np.empty(0, dtype=np.float32)
+    else:
+        members = unit_embeddings[order]
+        centroids = unit_rows(np.add.reduceat(members, starts, axis=0))
+        member_of = np.repeat(np.arange(len(labels)), np.diff(np.append(starts, len(order))))
+        similarities = np.einsum('ij,ij->i', members, centroids[member_of])
+        thresholds = np.minimum.reduceat(similarities, starts)
+
+    return {
+        'version': np.int64(version),
+        'labels': labels.astype(np.int64),
+        'centroids': centroids.astype(np.float16),
+        'thresholds': thresholds.astype(np.float32),
+    }
+
+
+def save_cluster_centroids(centroids, path=CENTROIDS_FILE):
+    np.savez(path, **centroids)
+    print(f"Saved {len(centroids['labels'])} cluster centroids")
+
+
+def assign_cluster(centroids, query_embedding):
+    """Cluster whose centroid is the most similar to a unit-norm query, -1 if it is not similar enough"""
+    if len(centroids['labels']) == 0:
+        return -1
+    similarities = centroids['centroids'].astype(np.float32) @ query_embedding
+    best = int(np.argmax(similarities))
+    return int(centroids['labels'][best]) if similarities[best] >= centroids['thresholds'][best] else -1
+
+
+def calculate_cluster_expansion(cursor, term_ids, cluster_ids):
+    """Top CLUSTER_EXPANSION_SIZE terms of every cluster by total tf, as (cluster, rank, term_id, total_tf) rows"""
+    cursor.execute("SELECT term_id, SUM(tf) FROM searchapp_invertedindex GROUP BY term_id")
+    total_tfs = dict(cursor.fetchall())
+
+    term_ids = np.array(term_ids, dtype=np.int64)
+    cluster_ids = np.array(cluster_ids, dtype=np.int64)
+    tfs = np.array([int(total_tfs.get(int(t), 0)) for t in term_ids], dtype=np.int64)
+
+    # Terms without any posting are never proposed
+    has_postings = tfs > 0
+    term_ids, cluster_ids, tfs = term_ids[has_postings], cluster_ids[has_postings], tfs[has_postings]
+
+    # Sort by cluster, then total tf descending, then term id
+    order = np.lexsort((term_ids, -tfs, cluster_ids))
+    term_ids, cluster_ids, tfs = term_ids[order], cluster_ids[order], tfs[order]
+    _, starts = np.unique(cluster_ids, return_index=True)
+    ranks = np.arange(len(cluster_ids)) - np.repeat(starts, np.diff(np.append(starts, len(cluster_ids))))
+
+    kept = ranks < CLUSTER_EXPANSION_SIZE
+    return list(zip(cluster_ids[kept].tolist(), ranks[kept].tolist(), term_ids[kept].tolist(), tfs[kept].tolist()))
+
+
+def save_cluster_expansion(cursor, rows):
+    cursor.execute("DELETE FROM searchapp_clusterexpansion")
+    cursor.executemany(
+        "INSERT INTO searchapp_clusterexpansion (cluster, `rank`, term_id, total_tf) VALUES (%s, %s, %s, %s)",
+        rows
+    )
 
 
 def update_term_clusters():
@@ -61,6 +292,11 @@ def update_term_clusters():
             # Save models
             joblib.dump(clusterer, CLUSTERER_FILE)
             model.save(MODEL_CACHE)
+            unit_embeddings = unit_rows(embeddings)
+            manifest = save_term_embeddings(term_ids, unit_embeddings)
+            version = manifest['version']
+            save_ann_index(build_ann_index(unit_embeddings, version))
+            save_cluster_centroids(build_cluster_centroids(unit_embeddings, clusters, version))
 
             # Update database
             update_sql = """
@@ -74,8 +310,16 @@ def update_term_clusters():
             batch_data = list(zip(term_ids, cluster_ids))
 
             cursor.executemany(update_sql, batch_data)
+
+            # Precompute the expansion of every cluster, in the same transaction as the clusters
+            save_cluster_expansion(cursor, calculate_cluster_expansion(cursor, term_ids, cluster_ids))
             conn.commit()
 
+        # Cluster labels change with every run, workers switch to the new files and tables together
+        publish_term_embeddings(manifest)
+        # Cached term expansions were computed with the previous clusters
+        bump_generation()
+
     finally:
         conn.close()
 
@@ -101,26 +345,20 @@ def expand_query(query_term):
                 print(f"Term {query_term} doesn't hit vocabulary")
                 # Handle new term
                 model = SentenceTransformer(MODEL_CACHE)
-                clusterer = joblib.load(CLUSTERER_FILE)
 
                 # Encode and normalize
                 query_embedding = model.encode([query_term])
                 query_embedding = query_embedding / np.linalg.norm(query_embedding)
 
-                # Predict cluster
-                cluster_id, _ = hdbscan.approximate_predict(clusterer, query_embedding)
-                cluster_id = int(cluster_id[0])
+                # Predict cluster by the nearest centroid
+                cluster_id = assign_cluster(np.load(CENTROIDS_FILE), query_embedding[0])
 
                 # Handle noise prediction
                 if cluster_id == -1:
-                    # Find nearest neighbor
-                    cursor.execute("SELECT id, term FROM searchapp_term")
-                    all_terms = cursor.fetchall()
-                    term_texts = [t[1] for t in all_terms]
-                    embeddings = model.encode(term_texts)
-                    nbrs = NearestNeighbors(n_neighbors=1).fit(embeddings)
-                    _, idx = nbrs.kneighbors(query_embedding)
-                    nearest_term_id = all_terms[idx[0][0]][0]
+                    # Find nearest neighbor through the ANN index
+                    term_ids, matrix, scales = load_term_embeddings()
+                    index = np.load(ANN_FILE)
+                    nearest_term_id = int(term_ids[ann_nearest(index, matrix, scales, query_embedding[0])])
 
                     # Get cluster of nearest neighbor
                     cursor.execute("""
@@ -131,14 +369,12 @@ def expand_query(query_term):
 
             # Get top terms in cluster
             cursor.execute("""
-                SELECT t.term, SUM(ii.tf) AS total_tf
-                FROM searchapp_termcluster tc
-                JOIN searchapp_term t ON tc.term_id = t.id
-                JOIN searchapp_invertedindex ii ON t.id = ii.term_id
-                WHERE tc.cluster = %s
+                SELECT t.term
+                FROM searchapp_clusterexpansion ce
+                JOIN searchapp_term t ON ce.term_id = t.id
+                WHERE ce.cluster = %s
                 AND t.term != %s
-                GROUP BY t.term
-                ORDER BY total_tf DESC
+                ORDER BY ce.`rank`
                 LIMIT 10
             """, (cluster_id, query_term))
 
@@ -0,0 +1,118 @@
+import os
+
+import pymysql
+import numpy as np
+from tqdm import tqdm
+
+from index_generation import bump_generation
+
+db_config = {
+        'host': '127.0.0.1',
+        'user': 'django',
+        'password': os.getenv("MYSQL_PASSWORD"),
+        'db': 'search_engine',
+        'charset': 'utf8mb4'
+    }
+
+
+def calculate_corpus_stats():
+    """Calculate per-term idf, per-document TF-IDF norm and length, and corpus-wide statistics"""
+
+    try:
+        conn = pymysql.connect(**db_config)
+
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM searchapp_document")
+            doc_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+            cursor.execute("SELECT id FROM searchapp_term")
+            term_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+            cursor.execute("SELECT term_id, document_id, tf FROM searchapp_invertedindex")
+            postings = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+
+    finally:
+        conn.close()
+
+    n_docs = len(doc_ids)
+    doc_ids.sort()
+    term_ids.sort()
+
+    # Keep postings whose term and document still exist
+    term_idx = np.searchsorted(term_ids, postings[:, 0])
+    doc_idx = np.searchsorted(doc_ids, postings[:, 1])
+    valid = (term_idx < len(term_ids)) & (doc_idx < n_docs)
+    valid[valid] &= (term_ids[term_idx[valid]] == postings[valid, 0]) & \
+                    (doc_ids[doc_idx[valid]] == postings[valid, 1])
+    term_idx, doc_idx, tfs = term_idx[valid], doc_idx[valid], postings[valid, 2].astype(np.float64)
+
+    # Smoothed idf, same formula as the search view
+    dfs = np.bincount(term_idx, minlength=len(term_ids))
+    idf = np.log((n_docs + 1) / (dfs + 1)) + 1
+
+    # Document length (number of indexed tokens) and the norm of the full TF-IDF vector
+    lengths = np.bincount(doc_idx, weights=tfs, minlength=n_docs)
+    norms = np.sqrt(np.bincount(doc_idx, weights=(tfs * idf[term_idx]) ** 2, minlength=n_docs))
+
+    return {
+        'n_docs': n_docs,
+        'n_terms': len(term_ids),
+        'avg_doc_length': float(lengths.mean()) if n_docs else 0.0,
+        'idf': dict(zip(term_ids.tolist(), idf.tolist())),
+        'documents': dict(zip(doc_ids.tolist(), zip(norms.tolist(), lengths.astype(np.int64).tolist()))),
+    }
+
+
+def save_corpus_stats(stats):
+    try:
+        conn = pymysql.connect(**db_config)
+        with conn.cursor() as cursor:
+            batch_size = 1000
+
+            doc_items = list(stats['documents'].items())
+            with tqdm(total=len(doc_items), desc="Storing document norms") as pbar:
+                for i in range(0, len(doc_items), batch_size):
+                    batch = [
+                        (float(norm), int(length), int(doc_id))
+                        for doc_id, (norm, length) in doc_items[i:i + batch_size]
+                    ]
+                    cursor.executemany(
+                        "UPDATE searchapp_document SET tfidf_norm = %s, doc_length = %s WHERE id = %s",
+                        batch
+                    )
+                    conn.commit()
+                    pbar.update(len(batch))
+
+            term_items = list(stats['idf'].items())
+            with tqdm(total=len(term_items), desc="Storing term idf") as pbar:
+                for i in range(0, len(term_items), batch_size):
+                    batch = [(float(idf), int(term_id)) for term_id, idf in term_items[i:i + batch_size]]
+                    cursor.executemany("UPDATE searchapp_term SET idf = %s WHERE id = %s", batch)
+                    conn.commit()
+                    pbar.update(len(batch))
+
+            # A new version is recorded last, readers only trust norms and idf once it exists
+            cursor.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM searchapp_corpusstatistics")
+            version = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                INSERT INTO searchapp_corpusstatistics (version, n_docs, n_terms, avg_doc_length, created_at)
+                VALUES (%s, %s, %s, %s, NOW())
+                """,
+                (version, stats['n_docs'], stats['n_terms'], stats['avg_doc_length'])
+            )
+            conn.commit()
+
+            print(f"Successfully stored corpus statistics version {version}")
+            return version
+
+    except Exception as e:
+        print(f"Error storing corpus statistics: {str(e)}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    result = calculate_corpus_stats()
+    save_corpus_stats(result)
+    bump_generation()
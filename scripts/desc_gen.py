@@ -12,6 +12,8 @@ import requests
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+from document_cards import invalidate_cards
+
 db_config = {
     'host': '127.0.0.1',
     'user': 'django',
@@ -62,6 +64,7 @@ Here is the html body you need to describe:
 def generate_desc():
     """Generate description using AI"""
 
+    updated = set()
     try:
         conn = pymysql.connect(**db_config)
 
@@ -101,6 +104,7 @@ def generate_desc():
                                     (new_description, record['id'])
                                 )
                                 conn.commit()
+                                updated.add(record['id'])
                                 print(f"Updated record {record['id']} with new description.")
                             except requests.RequestException as e:
                                 print(f"Request failed for {url}: {e}")
@@ -113,6 +117,8 @@ def generate_desc():
 
     finally:
         conn.close()
+        # Cached result cards show the previous description
+        invalidate_cards(updated)
 
 
 if __name__ == '__main__':
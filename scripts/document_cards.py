@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pymysql
+import redis
+
+db_config = {
+        'host': '127.0.0.1',
+        'user': 'django',
+        'password': os.getenv("MYSQL_PASSWORD"),
+        'db': 'search_engine',
+        'charset': 'utf8mb4'
+    }
+
+# Same Redis database as the "document_cards" cache of the Django project (djangoProject/redis_config.py)
+redis_config = {
+        'host': '127.0.0.1',
+        'port': 6379,
+        'db': 5,
+    }
+
+# Result cards are cached under card:{doc_id}:{content_hash} (searchApp/utils/document_cards.py),
+# the cache adds its own prefix and version in front of it
+CARD_KEY_MARKER = 'card:'
+BATCH_SIZE = 1000
+
+
+def linked_documents(doc_ids):
+    """Documents linking to or linked from some documents, their link lists show those documents"""
+
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return set()
+    linked = set()
+    try:
+        conn = pymysql.connect(**db_config)
+        with conn.cursor() as cursor:
+            for i in range(0, len(doc_ids), BATCH_SIZE):
+                batch = doc_ids[i:i + BATCH_SIZE]
+                placeholders = ', '.join(['%s'] * len(batch))
+                cursor.execute(
+                    f"""
+                    SELECT from_document_id, to_document_id FROM searchapp_urllinkage
+                    WHERE from_document_id IN ({placeholders}) OR to_document_id IN ({placeholders})
+                    """,
+                    batch + batch
+                )
+                for from_id, to_id in cursor.fetchall():
+                    linked.add(from_id)
+                    linked.add(to_id)
+    finally:
+        conn.close()
+    return linked
+
+
+def invalidate_cards(doc_ids):
+    """Delete the cached result cards of some documents, with one scan of the cards database"""
+
+    doc_ids = {str(doc_id) for doc_id in doc_ids}
+    if not doc_ids:
+        return 0
+    try:
+        connection = redis.Redis(**redis_config)
+        pipe = connection.pipeline(transaction=False)
+        deleted = 0
+        for key in connection.scan_iter(match=f'*{CARD_KEY_MARKER}*', count=BATCH_SIZE):
+            doc_id = key.decode().split(CARD_KEY_MARKER, 1)[1].split(':', 1)[0]
+            if doc_id in doc_ids:
+                pipe.delete(key)
+                deleted += 1
+        pipe.execute()
+        print(f"Invalidated {deleted} cached result cards")
+        return deleted
+    except redis.RedisError as e:
+        print(f"Error invalidating result cards: {str(e)}")
+        return 0
+
+
+if __name__ == '__main__':
+    # python scripts/document_cards.py <doc_id> [<doc_id> ...]
+    invalidate_cards(sys.argv[1:])
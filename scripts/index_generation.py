@@ -0,0 +1,28 @@
+import redis
+
+# Same Redis database as the "default" cache of the Django project (djangoProject/redis_config.py)
+redis_config = {
+        'host': '127.0.0.1',
+        'port': 6379,
+        'db': 1,
+    }
+
+# Search results are cached under the generation of the index that ranked them,
+# bumping it makes every cached search unreachable at once
+GENERATION_KEY = 'index_generation'
+
+
+def bump_generation():
+    """Increase the index generation after the inverted index or the link analysis scores changed"""
+
+    try:
+        generation = redis.Redis(**redis_config).incr(GENERATION_KEY)
+        print(f"Index generation is now {generation}")
+        return generation
+    except redis.RedisError as e:
+        print(f"Error bumping index generation: {str(e)}")
+        return None
+
+
+if __name__ == '__main__':
+    bump_generation()
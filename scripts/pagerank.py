@@ -4,6 +4,8 @@ import pymysql
 import numpy as np
 from tqdm import tqdm
 
+from index_generation import bump_generation
+
 db_config = {
         'host': '127.0.0.1',
         'user': 'django',
@@ -130,4 +132,5 @@ def save_to_db(pr_score):
 
 if __name__ == '__main__':
     result = calculate_pagerank()
-    save_to_db(result)
\ No newline at end of file
+    save_to_db(result)
+    bump_generation()
\ No newline at end of file
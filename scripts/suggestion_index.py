@@ -0,0 +1,79 @@
+import os
+
+import joblib
+import numpy as np
+import pymysql
+
+db_config = {
+        'host': '127.0.0.1',
+        'user': 'django',
+        'password': os.getenv("MYSQL_PASSWORD"),
+        'db': 'search_engine',
+        'charset': 'utf8mb4'
+    }
+
+SUGGESTION_FILE = 'suggestion_index.pkl'
+# Suggestions per prefix, and longest prefix whose suggestions are precomputed
+SUGGESTIONS_PER_PREFIX = 6
+MAX_PRECOMPUTED_PREFIX = 3
+
+
+def calculate_suggestion_index():
+    """Terms sorted alphabetically with their suggestion rank (df, then average PageRank of their documents)"""
+
+    try:
+        conn = pymysql.connect(**db_config)
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT t.term, t.df, AVG(d.pr_score)
+                FROM searchapp_term t
+                LEFT JOIN searchapp_invertedindex ii ON ii.term_id = t.id
+                LEFT JOIN searchapp_document d ON d.id = ii.document_id
+                GROUP BY t.id, t.term, t.df
+            """)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    terms = [row[0] for row in rows]
+    dfs = np.array([row[1] for row in rows], dtype=np.int64)
+    # Terms without documents come last among equal df, like NULL averages in the search view
+    avg_prs = np.array([row[2] if row[2] is not None else -1.0 for row in rows], dtype=np.float64)
+
+    # Rank 0 is the best suggestion: highest df, then highest average PageRank, then alphabetical
+    alphabetical = np.argsort(np.array(terms, dtype=object), kind='stable')
+    terms = [terms[i] for i in alphabetical]
+    dfs, avg_prs = dfs[alphabetical], avg_prs[alphabetical]
+    by_rank = np.lexsort((np.arange(len(terms)), -avg_prs, -dfs))
+    ranks = np.empty(len(terms), dtype=np.int64)
+    ranks[by_rank] = np.arange(len(terms))
+
+    # Best suggestions of every short prefix, filled in rank order
+    top = {}
+    for i in by_rank.tolist():
+        term = terms[i]
+        for length in range(min(len(term), MAX_PRECOMPUTED_PREFIX) + 1):
+            suggestions = top.setdefault(term[:length], [])
+            if len(suggestions) < SUGGESTIONS_PER_PREFIX:
+                suggestions.append(term)
+
+    return {
+        'terms': terms,
+        'dfs': dfs,
+        'avg_prs': avg_prs,
+        'ranks': ranks,
+        'top': top,
+        'max_precomputed_prefix': MAX_PRECOMPUTED_PREFIX,
+    }
+
+
+def save_suggestion_index(index, path=SUGGESTION_FILE):
+    # Workers reload the file when it changes, it is replaced at once so they never read it half written
+    joblib.dump(index, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    print(f"Saved suggestions of {len(index['terms'])} terms and {len(index['top'])} precomputed prefixes to {path}")
+
+
+if __name__ == '__main__':
+    result = calculate_suggestion_index()
+    save_suggestion_index(result)
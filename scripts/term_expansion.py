@@ -0,0 +1,77 @@
+import os
+
+import joblib
+import pymysql
+from lemminflect import getAllLemmas, getInflection
+from tqdm import tqdm
+
+db_config = {
+        'host': '127.0.0.1',
+        'user': 'django',
+        'password': os.getenv("MYSQL_PASSWORD"),
+        'db': 'search_engine',
+        'charset': 'utf8mb4'
+    }
+
+EXPANSION_FILE = 'term_expansion.pkl'
+
+
+def inflected_forms(term):
+    """Same morphological expansion as searchApp/utils/morphology.inflected_forms"""
+    expanded_terms = {term.lower()}
+
+    lemmas = getAllLemmas(term)
+    for pos in lemmas:
+        for lemma in lemmas[pos]:
+            if pos == 'NOUN':
+                plural = getInflection(lemma, 'NNS')
+                if plural:
+                    expanded_terms.add(plural[0].lower())
+
+            elif pos == 'VERB':
+                for tag in ('VBG', 'VBD', 'VBN', 'VBZ'):
+                    forms = getInflection(lemma, tag)
+                    if forms:
+                        expanded_terms.update(f.lower() for f in forms)
+
+    return expanded_terms
+
+
+def calculate_term_expansion():
+    """Map every surface form reachable from the vocabulary to the ids of its expansions in the vocabulary"""
+
+    try:
+        conn = pymysql.connect(**db_config)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id, term FROM searchapp_term")
+            vocabulary = {term: term_id for term_id, term in cursor.fetchall()}
+            # The search view only trusts the table while its index has these corpus statistics
+            cursor.execute("SELECT MAX(version) FROM searchapp_corpusstatistics")
+            stats_version = cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+    # Surface forms: the terms themselves and every inflection of them,
+    # so that "filmed" finds "films" / "filming" even if "filmed" was never indexed
+    surface_forms = set(vocabulary)
+    for term in tqdm(list(vocabulary), desc="Inflecting vocabulary"):
+        surface_forms.update(inflected_forms(term))
+
+    expansion = {}
+    for form in tqdm(surface_forms, desc="Expanding surface forms"):
+        term_ids = sorted(vocabulary[t] for t in inflected_forms(form) if t in vocabulary)
+        if term_ids:
+            expansion[form] = tuple(term_ids)
+
+    return {'n_terms': len(vocabulary), 'stats_version': stats_version, 'expansion': expansion}
+
+
+def save_term_expansion(table, path=EXPANSION_FILE):
+    joblib.dump(table, path)
+    print(f"Saved {len(table['expansion'])} surface forms over {table['n_terms']} terms "
+          f"(corpus statistics version {table['stats_version']}) to {path}")
+
+
+if __name__ == '__main__':
+    result = calculate_term_expansion()
+    save_term_expansion(result)
@@ -1,12 +1,15 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Document, Term, InvertedIndex, UrlLinkage,ForwardIndex, TermCluster
+from .models import Document, Term, InvertedIndex, UrlLinkage,PositionalIndex, TokenOffsets, TermCluster, ClusterExpansion, CorpusStatistics
 
 admin.site.register(Document)
 admin.site.register(Term)
 admin.site.register(InvertedIndex)
 admin.site.register(UrlLinkage)
-admin.site.register(ForwardIndex)
+admin.site.register(PositionalIndex)
+admin.site.register(TokenOffsets)
 admin.site.register(TermCluster)
+admin.site.register(ClusterExpansion)
+admin.site.register(CorpusStatistics)
 
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Avg
+
+from searchApp.models import Term
+from searchApp.utils import autocomplete
+
+
+class Command(BaseCommand):
+    help = "Repopulate the Redis sorted sets behind search suggestions, run it after each crawl"
+
+    def handle(self, *args, **options):
+        term_stats = Term.objects.annotate(
+            avg_pr=Avg('invertedindex__document__pr_score')
+        ).values_list('term', 'df', 'avg_pr')
+
+        generation = autocomplete.rebuild(term_stats.iterator())
+        self.stdout.write(self.style.SUCCESS(f"Autocomplete generation {generation} is live"))
@@ -14,6 +14,8 @@ class Document(models.Model):
     pr_score = models.FloatField(default=0.00)
     authority_score = models.FloatField(default=0.0)
     hub_score = models.FloatField(default=0.0)
+    tfidf_norm = models.FloatField(default=0.0)  # Norm of the full TF-IDF vector, see scripts/corpus_stats.py
+    doc_length = models.IntegerField(default=0)  # Number of indexed tokens
 
     class Meta:
         indexes = [
@@ -25,12 +27,24 @@ class Document(models.Model):
 class Term(models.Model):
     term = models.CharField(max_length=255, unique=True)
     df = models.IntegerField(default=1)
+    idf = models.FloatField(default=0.0)
 
     class Meta:
         indexes = [
             models.Index(fields=['term']),
         ]
 
+class CorpusStatistics(models.Model):
+    """
+    One row per run of scripts/corpus_stats.py. Term.idf and Document.tfidf_norm belong to the latest version.
+    """
+    version = models.IntegerField(unique=True)
+    n_docs = models.IntegerField(default=0)
+    n_terms = models.IntegerField(default=0)
+    avg_doc_length = models.FloatField(default=0.0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class TermCluster(models.Model):
     term = models.OneToOneField(Term, on_delete=models.CASCADE, primary_key=True)
     cluster = models.IntegerField()
@@ -40,6 +54,24 @@ class TermCluster(models.Model):
             models.Index(fields=['cluster']),
         ]
 
+class ClusterExpansion(models.Model):
+    """
+    Top terms of a cluster by total tf over the inverted index, written by scripts/clustering.py.
+    rank: 0 for the term with the highest total tf of the cluster
+    """
+    cluster = models.IntegerField()
+    rank = models.IntegerField()
+    term = models.ForeignKey(Term, on_delete=models.CASCADE)
+    total_tf = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name='unique_cluster_rank',
+                fields=['cluster', 'rank'],
+            )
+        ]
+
 class InvertedIndex(models.Model):
     term = models.ForeignKey(Term, on_delete=models.CASCADE)
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
@@ -65,16 +97,27 @@ class UrlLinkage(models.Model):
                 fields=['from_document', 'to_document'],
             )
         ]
-class ForwardIndex(models.Model):
+class TokenOffsets(models.Model):
+    """
+    Character offset in Document.content of every token (position - 1), encoded like PositionalIndex.positions.
+    """
+    document = models.OneToOneField(Document, on_delete=models.CASCADE, primary_key=True)
+    offsets = models.BinaryField()
+
+
+class PositionalIndex(models.Model):
+    """
+    Token positions of a term in a document, one row per (term, document) instead of one row per token.
+    positions: ascending positions, delta + varint encoded (see Spider/utils/DBHelper.encode_positions)
+    """
     term = models.ForeignKey(Term, on_delete=models.CASCADE)
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
-    position = models.IntegerField(blank=False)
+    positions = models.BinaryField()
 
     class Meta:
         constraints = [
             models.UniqueConstraint(
-                name='unique_term_position',
-                fields=['term_id', 'document_id','position'],
+                name='unique_term_doc_positions',
+                fields=['term_id', 'document_id'],
             )
         ]
-
@@ -1,3 +1,466 @@
-from django.test import TestCase
+import pickle
+import random
+import threading
+import time
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from Spider.utils.DBHelper import encode_positions
+from searchApp.models import Document, Term, InvertedIndex
+from searchApp.utils import scoring, index_generation, posting_cache, fuzzy_index, single_flight, \
+    query_encoder, tiered_cache
+from searchApp.utils.index_engine import IndexEngine
+from searchApp.utils.positional_index import decode_positions
+
+
+class TopKTests(TestCase):
+    """
+    top_k must return exactly the first k documents of the full ranking of score_documents.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(5930)
+        documents = [Document.objects.create(
+            url=f'https://www.cse.ust.hk/{i}.html', content_hash=str(i), content='',
+            pr_score=rng.paretovariate(2), authority_score=rng.random() * rng.random(), hub_score=rng.random(),
+        ) for i in range(150)]
+        for t in range(12):
+            # From a few documents to most of them
+            containing = rng.sample(documents, max(1, int(len(documents) * rng.random() ** 2)))
+            term = Term.objects.create(term=f'term{t}', df=len(containing))
+            InvertedIndex.objects.bulk_create(
+                InvertedIndex(term=term, document=document, tf=rng.randint(1, 20)) for document in containing
+            )
+
+    def setUp(self):
+        with mock.patch.object(index_generation, 'current_generation', return_value=1):
+            self.engine = IndexEngine().load()
+
+    def assertSameRanking(self, term_ids, weights, k, allowed_rows=None):
+        full = scoring.score_documents(self.engine, term_ids, weights)
+        if allowed_rows is not None:
+            full = scoring.ScoredDocuments(*(field[np.isin(full.doc_rows, allowed_rows)] for field in full))
+        order = np.lexsort((full.doc_rows, -full.final))[:k]
+        top = scoring.top_k(self.engine, term_ids, weights, k, allowed_rows=allowed_rows)
+
+        np.testing.assert_array_equal(top.doc_ids, full.doc_ids[order])
+        np.testing.assert_allclose(top.final, full.final[order])
+        np.testing.assert_allclose(top.relevance, full.relevance[order])
+        np.testing.assert_allclose(top.hits, full.hits[order])
+
+    def test_top_k_matches_full_sort(self):
+        rng = random.Random(0)
+        term_ids = self.engine.term_ids.tolist()
+        # Small blocks so that the walk stops early and skips non-essential lists
+        with mock.patch.object(scoring, 'TOP_K_BLOCK_SIZE', 8):
+            for _ in range(30):
+                query = rng.sample(term_ids, rng.randint(1, 4))
+                weights = [1.0] + [0.8] * (len(query) - 1)
+                for k in (1, 5, 20, 1000):
+                    with self.subTest(query=query, k=k):
+                        self.assertSameRanking(query, weights, k)
+
+    def test_top_k_with_allowed_rows(self):
+        term_ids = self.engine.term_ids.tolist()[:3]
+        allowed_rows = np.arange(0, self.engine.n_docs, 3)
+        with mock.patch.object(scoring, 'TOP_K_BLOCK_SIZE', 8):
+            self.assertSameRanking(term_ids, [1.0, 1.0, 1.0], 10, allowed_rows=allowed_rows)
+
+
+class PositionEncodingTests(SimpleTestCase):
+    """
+    Blobs written by the spider (encode_positions) must decode to the same positions.
+    """
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            # Gaps from 1 to several varint bytes, and empty lists
+            positions = sorted(rng.sample(range(1, 10 ** rng.randint(2, 9)), rng.randint(0, 50)))
+            with self.subTest(positions=positions[:5]):
+                decoded = decode_positions(encode_positions(positions))
+                self.assertEqual(decoded.tolist(), positions)
+
+    def test_decode_many(self):
+        lists = [[1, 2, 3], [], [127, 128, 16384, 2 ** 31], [5]]
+        offsets, positions = posting_cache.decode_many([encode_positions(p) for p in lists])
+        self.assertEqual([positions[offsets[i]:offsets[i + 1]].tolist() for i in range(len(lists))], lists)
+
+
+class FuzzyLookupTests(SimpleTestCase):
+    """
+    The symmetric delete index must find the same closest term as comparing the word with the whole vocabulary.
+    """
+
+    ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+    @staticmethod
+    def osa_distance(a, b):
+        # Full optimal string alignment table
+        d = [[i + j if i * j == 0 else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+        for i in range(1, len(a) + 1):
+            for j in range(1, len(b) + 1):
+                d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1, d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+        return d[-1][-1]
+
+    def test_edit_distance(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            a = ''.join(rng.choices('abcd', k=rng.randint(0, 7)))
+            b = ''.join(rng.choices('abcd', k=rng.randint(0, 7)))
+            for max_distance in (1, 2):
+                self.assertEqual(fuzzy_index.edit_distance(a, b, max_distance),
+                                 min(self.osa_distance(a, b), max_distance + 1), (a, b, max_distance))
+
+    def test_lookup_matches_brute_force(self):
+        rng = random.Random(0)
+        terms = sorted({''.join(rng.choices(self.ALPHABET, k=rng.randint(2, 12))) for _ in range(2000)})
+        dfs = np.array([rng.randint(1, 100) for _ in terms])
+        index = fuzzy_index.FuzzyIndex(terms, dfs)
+
+        for _ in range(300):
+            word = list(rng.choice(terms))
+            for _ in range(rng.randint(1, 2)):
+                i = rng.randrange(len(word))
+                operation = rng.randint(0, 3)
+                if operation == 0:
+                    word[i] = rng.choice(self.ALPHABET)
+                elif operation == 1 and len(word) > 1:
+                    del word[i]
+                elif operation == 2 and i > 0:
+                    word[i - 1], word[i] = word[i], word[i - 1]
+                else:
+                    word.insert(i, rng.choice(self.ALPHABET))
+            word = ''.join(word)
+
+            max_distance = 1 if len(word) <= fuzzy_index.SHORT_WORD_LENGTH else fuzzy_index.MAX_EDIT_DISTANCE
+            candidates = sorted((self.osa_distance(word, term), -dfs[row], term) for row, term in enumerate(terms)
+                                if abs(len(term) - len(word)) <= max_distance)
+            expected = [(term, distance) for distance, _, term in candidates[:1] if distance <= max_distance]
+            with self.subTest(word=word):
+                self.assertEqual(index.lookup(word), expected)
+
+
+class SingleFlightTests(SimpleTestCase):
+    """
+    Concurrent callers of single_flight.run with the same key share one computation (threads of one worker,
+    the Redis side is not used without a Redis cache backend).
+    """
+
+    THREADS = 8
+
+    class _RecordingFlights(dict):
+        # Counts the callers that looked up the key, they hold its Event (or own it) afterwards
+        def __init__(self):
+            super().__init__()
+            self.lookups = threading.Semaphore(0)
+
+        def get(self, key, default=None):
+            self.lookups.release()
+            return super().get(key, default)
+
+    def setUp(self):
+        patcher = mock.patch.object(single_flight, 'get_redis_connection', side_effect=NotImplementedError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.flights = self._RecordingFlights()
+        patcher = mock.patch.object(single_flight, '_flights', self.flights)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_concurrently(self, load, compute):
+        results = [None] * self.THREADS
+        errors = []
+
+        def call(i):
+            try:
+                results[i] = single_flight.run('query', load, compute, wait_timeout=10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def wait_for_every_caller(self):
+        for _ in range(self.THREADS):
+            self.assertTrue(self.flights.lookups.acquire(timeout=10))
+
+    def test_one_leader_computes(self):
+        store = {}
+        computations = []
+        release = threading.Event()
+
+        def compute():
+            computations.append(threading.current_thread())
+            self.assertTrue(release.wait(10))
+            store['value'] = 42
+            return 42
+
+        threads, results, errors = self.run_concurrently(lambda: store.get('value'), compute)
+        self.wait_for_every_caller()
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(computations), 1)
+        self.assertEqual(sorted(results), [(42, False)] + [(42, True)] * (self.THREADS - 1))
+        self.assertEqual(self.flights, {})
+
+    def test_followers_compute_when_the_leader_fails(self):
+        computations = []
+        release = threading.Event()
+
+        def compute():
+            computations.append(threading.current_thread())
+            if len(computations) == 1:
+                self.assertTrue(release.wait(10))
+                raise RuntimeError('ranking failed')
+            return 7
+
+        threads, results, errors = self.run_concurrently(lambda: None, compute)
+        self.wait_for_every_caller()
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual([str(e) for e in errors], ['ranking failed'])
+        self.assertEqual(len(computations), self.THREADS)
+        self.assertEqual(sorted(result for result in results if result is not None), [(7, False)] * (self.THREADS - 1))
+
+    def test_stored_value_is_not_computed(self):
+        compute = mock.Mock()
+        self.assertEqual(single_flight.run('query', lambda: 'cached', compute), ('cached', True))
+        compute.assert_not_called()
+
+
+class BatchingEncoderTests(SimpleTestCase):
+    """
+    Texts requested while the model is busy are encoded together in the next model call, once per distinct text.
+    """
+
+    class _BlockingModel:
+        def __init__(self):
+            self.calls = []
+            self.gate = threading.Event()
+
+        def encode(self, texts):
+            self.calls.append(list(texts))
+            # The first call holds the model until the test has queued the next requests
+            if len(self.calls) == 1:
+                assert self.gate.wait(10)
+            return np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+
+    @staticmethod
+    def expected(text):
+        vector = np.array([len(text), 1.0], dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def wait_until(self, condition):
+        for _ in range(1000):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('timed out')
+
+    def test_concurrent_requests_share_one_call(self):
+        model = self._BlockingModel()
+        encoder = query_encoder.BatchingEncoder(model, batch_window=0.001)
+        results = {}
+
+        def encode(name, texts):
+            results[name] = encoder.encode(texts)
+
+        first = threading.Thread(target=encode, args=('first', ['warm']))
+        first.start()
+        self.wait_until(lambda: len(model.calls) == 1)
+
+        requests = {'a': ['alpha', 'Beta'], 'b': ['beta', 'gamma'], 'c': ['ALPHA  ', 'delta']}
+        threads = [threading.Thread(target=encode, args=item) for item in requests.items()]
+        for thread in threads:
+            thread.start()
+        # 'alpha' and 'beta' are asked twice (different spacing and case), they are pending once
+        self.wait_until(lambda: len(encoder._pending) == 4)
+        model.gate.set()
+        for thread in [first] + threads:
+            thread.join(10)
+
+        self.assertEqual(len(model.calls), 2)
+        self.assertEqual(sorted(model.calls[1]), ['alpha', 'beta', 'delta', 'gamma'])
+        for name, texts in [('first', ['warm'])] + list(requests.items()):
+            np.testing.assert_allclose(results[name], [self.expected(text.strip().lower()) for text in texts],
+                                       rtol=1e-6)
+
+        # Every text is cached now
+        encoder.encode(['gamma', 'Warm'])
+        self.assertEqual(len(model.calls), 2)
+
+    def test_model_errors_reach_every_waiting_request(self):
+        model = mock.Mock()
+        model.encode.side_effect = RuntimeError('model failed')
+        encoder = query_encoder.BatchingEncoder(model, batch_window=0.001)
+        with self.assertRaisesMessage(RuntimeError, 'model failed'):
+            encoder.encode(['alpha'])
+        # Nothing is cached, the next request calls the model again
+        with self.assertRaisesMessage(RuntimeError, 'model failed'):
+            encoder.encode(['alpha'])
+        self.assertEqual(model.encode.call_count, 2)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'remote': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'remote'},
+})
+class TieredCacheTests(SimpleTestCase):
+    """
+    The local tier is bounded by the bytes of the pickled values, evicts the least recently used entries first and is
+    emptied when the index generation changes. The remote tier (here a local memory cache) keeps everything.
+    """
+
+    def setUp(self):
+        self.generation = 1
+        patcher = mock.patch.object(index_generation, 'current_generation', side_effect=lambda: self.generation)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches['remote'].clear()
+        self.value_bytes = len(pickle.dumps(b'x' * 100, protocol=pickle.HIGHEST_PROTOCOL))
+        # Room for 4 values (with MAX_ENTRY_SHARE raised, a value is at most 5% of a tier otherwise)
+        self.tier = tiered_cache.TieredCache('remote', 4 * self.value_bytes)
+
+    def test_local_tier_is_bounded_in_bytes(self):
+        with mock.patch.object(tiered_cache, 'MAX_ENTRY_SHARE', 1.0):
+            for i in range(10):
+                self.tier.set(f'k{i}', b'x' * 100, 60)
+                self.assertLessEqual(self.tier.size, self.tier.max_bytes)
+            self.assertEqual(list(self.tier.entries), ['k6', 'k7', 'k8', 'k9'])
+
+            # Reading k6 makes k7 the least recently used
+            self.tier.get('k6')
+            self.tier.set('k10', b'x' * 100, 60)
+            self.assertEqual(list(self.tier.entries), ['k8', 'k9', 'k6', 'k10'])
+
+        # Evicted values are still read from Redis
+        self.assertEqual(self.tier.get('k0'), b'x' * 100)
+
+    def test_large_values_stay_remote(self):
+        self.tier.set('large', b'x' * 1000, 60)
+        self.assertEqual(self.tier.entries, {})
+        self.assertEqual(self.tier.get('large'), b'x' * 1000)
+
+    def test_local_hits_skip_redis(self):
+        with mock.patch.object(tiered_cache, 'MAX_ENTRY_SHARE', 1.0):
+            self.tier.set_many({'a': b'x' * 100, 'b': b'y' * 100}, timeout=60)
+            caches['remote'].clear()
+            stats = Counter()
+            self.assertEqual(self.tier.get_many(['a', 'b', 'c'], stats=stats), {'a': b'x' * 100, 'b': b'y' * 100})
+        self.assertEqual(stats, Counter(local_hits=2, misses=1, round_trips=1))
+
+    def test_generation_change_clears_local_tier(self):
+        with mock.patch.object(tiered_cache, 'MAX_ENTRY_SHARE', 1.0):
+            self.tier.set('a', b'x' * 100, 60)
+            caches['remote'].delete('a')
+            self.assertEqual(self.tier.get('a'), b'x' * 100)
+
+            self.generation = 2
+            self.assertIsNone(self.tier.get('a'))
+        self.assertEqual((self.tier.entries, self.tier.size), ({}, 0))
+
+
+@override_settings(POSTING_CACHE_REDIS=False)
+class PostingCacheTests(SimpleTestCase):
+    """
+    Greedy-Dual-Size-Frequency eviction of the posting cache, and background loading of missing terms.
+    """
+
+    class _Engine:
+        generation = 1
+
+        def __init__(self, df=1):
+            self.df = lambda term_id: df
+
+    @staticmethod
+    def positions(n_positions):
+        return posting_cache.TermPositions(np.zeros(1, dtype=np.int64), np.array([0, n_positions], dtype=np.int64),
+                                           np.arange(n_positions, dtype=np.int32))
+
+    def load(self, cache, sizes):
+        with mock.patch.object(posting_cache, 'load_term_positions',
+                               side_effect=lambda term_ids: {tid: self.positions(sizes[tid]) for tid in term_ids}):
+            cache.load(list(sizes))
+
+    def test_large_terms_are_evicted_first(self):
+        small, large = self.positions(10).nbytes, self.positions(10000).nbytes
+        cache = posting_cache.PostingCache(self._Engine(), max_bytes=large + 2 * small)
+        self.load(cache, {1: 10000, 2: 10, 3: 10})
+        self.load(cache, {4: 10})
+        self.assertEqual(sorted(cache.entries), [2, 3, 4])
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_frequent_terms_stay(self):
+        cache = posting_cache.PostingCache(self._Engine(), max_bytes=2 * self.positions(10).nbytes)
+        self.load(cache, {1: 10, 2: 10})
+        for _ in range(5):
+            cache.get_many([1])
+        self.load(cache, {3: 10})
+        self.assertEqual(sorted(cache.entries), [1, 3])
+        # The clock moved up to the evicted priority, newer entries start from there
+        self.assertGreater(cache.clock, 0)
+
+    def test_idle_terms_age_out(self):
+        cache = posting_cache.PostingCache(self._Engine(), max_bytes=2 * self.positions(10).nbytes)
+        self.load(cache, {1: 10})
+        for _ in range(5):
+            cache.get_many([1])
+        self.load(cache, {2: 10})
+        self.load(cache, {3: 10})
+        self.assertIn(1, cache.entries)
+        # Every eviction moves the clock up, new terms end up above the frequency term 1 earned long ago
+        for term_id in range(4, 20):
+            self.load(cache, {term_id: 10})
+        self.assertNotIn(1, cache.entries)
+
+    def test_heap_stays_bounded_on_hits(self):
+        cache = posting_cache.PostingCache(self._Engine())
+        self.load(cache, {1: 10, 2: 10})
+        for _ in range(10000):
+            cache.get_many([1, 2])
+        self.assertLessEqual(len(cache.heap), 4 * len(cache.entries) + 64)
+
+    def test_missing_terms_are_loaded_once_in_the_background(self):
+        cache = posting_cache.PostingCache(self._Engine())
+        release = threading.Event()
+        loads = []
+
+        def load_term_positions(term_ids):
+            loads.append(list(term_ids))
+            assert release.wait(10)
+            return {tid: self.positions(3) for tid in term_ids}
+
+        with mock.patch.object(posting_cache, 'load_term_positions', side_effect=load_term_positions):
+            self.assertEqual(cache.get_many([1, 2]), {})
+            # Still loading, not requested again
+            self.assertEqual(cache.get_many([1]), {})
+            release.set()
+            for _ in range(1000):
+                if not cache.loading:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(loads, [[1, 2]])
+        self.assertEqual(sorted(cache.get_many([1, 2])), [1, 2])
+
+    def test_terms_in_many_documents_are_not_cached(self):
+        cache = posting_cache.PostingCache(self._Engine(df=posting_cache.MAX_CACHED_DF + 1))
+        with mock.patch.object(posting_cache, 'load_term_positions') as load_term_positions:
+            self.assertEqual(cache.get_many([1]), {})
+        self.assertEqual(cache.loading, set())
+        load_term_positions.assert_not_called()
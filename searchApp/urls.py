@@ -15,5 +15,6 @@ urlpatterns = [
     path('ai-analysis/', views.ai_analysis, name='ai_analysis'),
     path('pages/<int:page_number>/', views.pages, name='pages'),
     path('pages/', views.pages, {'page_number': 1}),  # 设置默认参数
+    path('cache-stats/', views.cache_stats, name='cache_stats'),
 
 ]
\ No newline at end of file
@@ -1 +1,3 @@
-from . import aliyun_helper, vague_searcher
\ No newline at end of file
+from . import aliyun_helper, vague_searcher, index_engine, scoring, hydration, positional_index, snippets, morphology, \
+    embedding_store, ann_index, cluster_centroids, query_encoder, suggestion_index, autocomplete, fuzzy_index, \
+    index_generation, tiered_cache, cache_batch, result_cache, single_flight, posting_cache, document_cards
\ No newline at end of file
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+# Description: Approximate nearest neighbour search (IVF) over the term embeddings
+# Note: The index is built by scripts/clustering.py (build_ann_index) for one version of the term embeddings
+
+import numpy as np
+
+ANN_FILE = 'term_ann.npz'
+# Inverted lists probed per query, more lists means better recall and slower queries
+ANN_NPROBE = 8
+
+
+class IVFIndex:
+    """
+    Inverted file index: the embeddings are split by their nearest coarse centroid, a query only scores the
+    embeddings of the `nprobe` centroids closest to it.
+
+    centroids: unit-norm centroids, shape (n_lists, dim)
+    offsets: rows[offsets[c]:offsets[c + 1]] are the embedding rows of centroid c
+    rows: embedding rows grouped by centroid
+    """
+
+    def __init__(self, embeddings, centroids, offsets, rows):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query_embedding, k=1, nprobe=ANN_NPROBE):
+        """
+        search: the k terms closest to a unit-norm query embedding.
+        Returns: (term ids, cosine similarities), best first
+        """
+        centroid_scores = self.centroids @ query_embedding
+        probe = np.argpartition(-centroid_scores, min(nprobe, len(centroid_scores)) - 1)[:nprobe]
+        candidates = np.sort(np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in probe]))
+
+        similarities = self.embeddings.scores(query_embedding, candidates)
+        best = np.argsort(-similarities, kind='stable')[:k]
+        return self.embeddings.term_ids[candidates[best]], similarities[best]
+
+    def nearest(self, query_embedding):
+        term_ids, similarities = self.search(query_embedding, k=1)
+        return int(term_ids[0]), float(similarities[0])
+
+
+def load_ann_index(embeddings, path=ANN_FILE):
+    """
+    load_ann_index: open the ANN index built over `embeddings` (a TermEmbeddings).
+    Returns: the index, None if it is missing or was built over another version of the embeddings
+    """
+    try:
+        data = np.load(path)
+    except FileNotFoundError:
+        return None
+    if int(data['version']) != embeddings.version or len(data['rows']) != len(embeddings):
+        return None
+    return IVFIndex(embeddings, data['centroids'], data['offsets'], data['rows'])
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+# Description: Search suggestions from Redis sorted sets, shared by every worker and node
+# Note: Populated by `python manage.py rebuild_autocomplete`, run it after each crawl
+
+import time
+from collections import Counter
+
+from django_redis import get_redis_connection
+
+# Redis connection (cache alias) holding the sorted sets
+AUTOCOMPLETE_CACHE = 'search_suggestions'
+KEY_PREFIX = 'autocomplete'
+SUGGESTIONS_PER_PREFIX = 6
+# Prefixes up to this length get their own sorted set of best suggestions
+MAX_PRECOMPUTED_PREFIX = 3
+# Longer prefixes are answered by ranking their whole ZRANGEBYLEX range, up to this many terms.
+# Prefixes with more completions than that get a sorted set of best suggestions too, whatever their length
+MAX_LEX_CANDIDATES = 500
+BATCH_SIZE = 1000
+# Seconds a replaced generation stays readable for requests that already read its number
+STALE_GENERATION_TTL = 60
+
+
+def _key(generation, name):
+    return f'{KEY_PREFIX}:{generation}:{name}'
+
+
+def suggestion_score(df, avg_pr, max_avg_pr):
+    """
+    suggestion_score: df first, the average PageRank of the term's documents (scaled into [0, 1)) breaks ties.
+    """
+    if avg_pr is None or max_avg_pr <= 0:
+        return float(df)
+    return df + avg_pr / (max_avg_pr * (1 + 1e-9))
+
+
+def rebuild(term_stats, connection=None):
+    """
+    rebuild: write a new generation of the sorted sets, switch readers to it, then let the previous one expire.
+    Args:
+        term_stats: iterable of (term, df, average PageRank or None)
+
+    Returns: the new generation
+    """
+    redis = connection or get_redis_connection(AUTOCOMPLETE_CACHE)
+    term_stats = list(term_stats)
+    max_avg_pr = max((avg_pr for _, _, avg_pr in term_stats if avg_pr is not None), default=0.0)
+
+    previous = redis.get(_key('current', 'generation'))
+    generation = str(time.time_ns())
+
+    # Prefixes too wide to rank their lex range at query time
+    completions = Counter(term[:length] for term, _, _ in term_stats for length in range(len(term) + 1))
+    wide_prefixes = {prefix for prefix, count in completions.items()
+                     if len(prefix) <= MAX_PRECOMPUTED_PREFIX or count > MAX_LEX_CANDIDATES}
+
+    # lex: every term with score 0, ordered by member so a prefix is a ZRANGEBYLEX range
+    # score: term -> suggestion score
+    # top:{prefix}: best terms of a short or wide prefix
+    top = {}
+    pipe = redis.pipeline(transaction=False)
+    for i, (term, df, avg_pr) in enumerate(term_stats):
+        score = suggestion_score(df, avg_pr, max_avg_pr)
+        pipe.zadd(_key(generation, 'lex'), {term: 0})
+        pipe.zadd(_key(generation, 'score'), {term: score})
+        for length in range(len(term) + 1):
+            if term[:length] in wide_prefixes:
+                top.setdefault(term[:length], []).append((score, term))
+        if (i + 1) % BATCH_SIZE == 0:
+            pipe.execute()
+
+    for prefix, scored_terms in top.items():
+        best = sorted(scored_terms, key=lambda x: (-x[0], x[1]))[:SUGGESTIONS_PER_PREFIX]
+        pipe.zadd(_key(generation, f'top:{prefix}'), {term: score for score, term in best})
+    pipe.set(_key('current', 'generation'), generation)
+    pipe.execute()
+
+    if previous is not None:
+        pipe = redis.pipeline(transaction=False)
+        for key in redis.scan_iter(match=_key(previous.decode(), '*'), count=BATCH_SIZE):
+            pipe.expire(key, STALE_GENERATION_TTL)
+        pipe.execute()
+
+    return generation
+
+
+def suggest(prefix, k=SUGGESTIONS_PER_PREFIX, connection=None):
+    """
+    suggest: the best k terms starting with prefix.
+    Returns: list of terms, None if the sorted sets have never been built
+    """
+    redis = connection or get_redis_connection(AUTOCOMPLETE_CACHE)
+    generation = redis.get(_key('current', 'generation'))
+    if generation is None:
+        return None
+    generation = generation.decode()
+
+    if len(prefix) <= MAX_PRECOMPUTED_PREFIX and k <= SUGGESTIONS_PER_PREFIX:
+        return _top(redis, generation, prefix, k)
+
+    # 0xff never occurs in UTF-8, so it sorts after every term starting with the prefix
+    encoded = prefix.encode()
+    lex_range = (_key(generation, 'lex'), b'[' + encoded, b'[' + encoded + b'\xff')
+    if k <= SUGGESTIONS_PER_PREFIX:
+        candidates = redis.zrangebylex(*lex_range, start=0, num=MAX_LEX_CANDIDATES + 1)
+        if len(candidates) > MAX_LEX_CANDIDATES:
+            # A wide prefix, its best terms were precomputed
+            return _top(redis, generation, prefix, k)
+    else:
+        candidates = redis.zrangebylex(*lex_range)
+    if not candidates:
+        return []
+    scores = redis.zmscore(_key(generation, 'score'), candidates)
+    ranked = sorted(zip(candidates, scores), key=lambda x: (-(x[1] or 0), x[0]))[:k]
+    return [term.decode() for term, _ in ranked]
+
+
+def _top(redis, generation, prefix, k):
+    ranked = redis.zrevrange(_key(generation, f'top:{prefix}'), 0, k - 1, withscores=True)
+    ranked.sort(key=lambda x: (-x[1], x[0]))
+    return [term.decode() for term, _ in ranked]
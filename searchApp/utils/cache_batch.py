@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+# Description: Request-scoped cache access, keys are read with one MGET and written with one pipeline per Redis db
+# Note: Each cache alias is its own Redis db, every alias goes through its tiered_cache.TieredCache
+
+import threading
+from collections import Counter
+
+from searchApp.utils import tiered_cache
+
+# Counters of every batch of this worker since it started
+_totals = Counter()
+_totals_lock = threading.Lock()
+
+
+class CacheBatch:
+    """
+    fetched: (alias, key) -> value read by this request
+    writes: (alias, timeout) -> {key: value} waiting for flush()
+    stats: local_hits, remote_hits, misses, writes and round_trips of this batch
+    """
+
+    def __init__(self):
+        self.fetched = {}
+        self.writes = {}
+        self.stats = Counter()
+
+    def get(self, alias, key):
+        """
+        get: value of a key, None on a miss.
+        """
+        return self.get_many(alias, [key]).get(key)
+
+    def get_many(self, alias, keys):
+        """
+        get_many: values of many keys, the ones this request has not read yet are fetched with a single MGET.
+        Misses are not remembered, reading the key again goes to the cache, so a value stored meanwhile
+        (e.g. by another worker) is seen.
+        Returns: a dictionary key -> value, misses are left out
+        """
+        missing = list(dict.fromkeys(key for key in keys if (alias, key) not in self.fetched))
+        if missing:
+            values = tiered_cache.get_cache(alias).get_many(missing, stats=self.stats)
+            for key, value in values.items():
+                self.fetched[(alias, key)] = value
+        return {key: self.fetched[(alias, key)] for key in keys if (alias, key) in self.fetched}
+
+    def set(self, alias, key, value, timeout):
+        """
+        set: store a value with the next flush(), it is visible to get() right away.
+        """
+        self.writes.setdefault((alias, timeout), {})[key] = value
+        self.fetched[(alias, key)] = value
+
+    def flush(self):
+        """
+        flush: write the stored values, one pipeline per cache alias and timeout.
+        """
+        for (alias, timeout), values in self.writes.items():
+            tiered_cache.get_cache(alias).set_many(values, timeout=timeout, stats=self.stats)
+        self.writes = {}
+
+    def close(self):
+        """
+        close: flush, then add the counters of this batch to the totals of the worker.
+        """
+        self.flush()
+        with _totals_lock:
+            _totals.update(self.stats)
+
+    def summary(self):
+        return ';'.join(f'{name}={count}' for name, count in sorted(self.stats.items()))
+
+
+def totals():
+    """
+    totals: counters of every closed batch of this worker.
+    """
+    with _totals_lock:
+        return dict(_totals)
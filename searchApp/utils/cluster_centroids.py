@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+# Description: Assignment of unseen query terms to a term cluster by their nearest centroid
+# Note: Centroids are exported by scripts/clustering.py (build_cluster_centroids) as float16
+
+import numpy as np
+
+CENTROIDS_FILE = 'cluster_centroids.npz'
+# Centroids upcast to float32 at once while scoring, bounds the temporary memory
+CENTROID_CHUNK_SIZE = 8192
+
+
+class CentroidAssigner:
+    """
+    labels: cluster label of every centroid (the TermCluster.cluster value)
+    centroids: unit-norm centroids, float16, shape (n_clusters, dim)
+    thresholds: lowest similarity between a member of the cluster and its centroid
+    """
+
+    def __init__(self, labels, centroids, thresholds):
+        self.labels = labels
+        self.centroids = centroids
+        self.thresholds = thresholds
+
+    def __len__(self):
+        return len(self.labels)
+
+    def assign(self, query_embedding):
+        """
+        assign: the cluster of a unit-norm query embedding.
+        Returns: the cluster label, None if no centroid is as close to the query as the members of its cluster
+        """
+        if len(self) == 0:
+            return None
+        query_embedding = query_embedding.astype(np.float32, copy=False)
+        similarities = np.concatenate([
+            self.centroids[i:i + CENTROID_CHUNK_SIZE].astype(np.float32) @ query_embedding
+            for i in range(0, len(self), CENTROID_CHUNK_SIZE)
+        ])
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.thresholds[best]:
+            return None
+        return int(self.labels[best])
+
+
+def load_cluster_centroids(embeddings, path=CENTROIDS_FILE):
+    """
+    load_cluster_centroids: open the centroids exported with `embeddings` (a TermEmbeddings).
+    Returns: a CentroidAssigner, None if the file is missing or belongs to another clustering run
+    """
+    try:
+        data = np.load(path)
+    except FileNotFoundError:
+        return None
+    if int(data['version']) != embeddings.version:
+        return None
+    return CentroidAssigner(data['labels'], data['centroids'], data['thresholds'])
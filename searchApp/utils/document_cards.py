@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+# Description: Cached result cards, the query independent part of a result row
+# Note: Keyed by document id and content hash, a re-crawled document gets a new card.
+#       The spider and scripts/desc_gen.py drop the cards whose link lists or description changed (scripts/document_cards.py),
+#       cards are only kept in Redis so every worker sees that at once
+
+import os
+from urllib.parse import urlparse
+
+from searchApp.utils import hydration
+
+CARDS_CACHE = 'document_cards'
+# Link lists also show other documents, this bounds how long a card misses a link added elsewhere
+CARD_TIMEOUT = 24 * 60 * 60
+
+
+# Generate display url
+def process_url(url):
+    parsed = urlparse(url)
+    domain = parsed.netloc
+    path = parsed.path.lstrip('/')
+    parts = path.split('/')
+    if parts:
+        last_part = parts[-1]
+        filename, ext = os.path.splitext(last_part)
+        parts[-1] = filename
+
+    result = f"{parsed.scheme}://{domain} > " + ' > '.join(parts)
+    return result
+
+
+def card_key(doc_id, content_hash):
+    return f'card:{doc_id}:{content_hash}'
+
+
+def make_card(doc, related):
+    """
+    make_card: card of a document.
+    Args:
+        doc: Document (url and description are used)
+        related: its hydration.hydrate_documents() entry
+
+    Returns: {'display_url', 'snippet', 'desc_ai', 'keywords', 'from_docs', 'to_docs'}
+    """
+    # GENAI label judgement
+    description_ai = False
+    description = doc.description
+    if description.split("`")[-1] == "AIDESC":
+        description_ai = True
+        description = "`".join(description.split("`")[:-1])
+
+    return {
+        'display_url': process_url(doc.url),
+        'snippet': description,
+        'desc_ai': description_ai,
+        'keywords': related['keywords'],
+        'from_docs': related['from_docs'],
+        'to_docs': related['to_docs'],
+    }
+
+
+def get_cards(docs, batch):
+    """
+    get_cards: cards of many documents with one MGET, the missing ones are built with one hydration.
+    Args:
+        docs: list of Document (id, content_hash, url and description are used)
+        batch: cache_batch.CacheBatch of the request, new cards are written by its next flush()
+
+    Returns: a dictionary doc_id -> card
+    """
+    keys = {doc.id: card_key(doc.id, doc.content_hash) for doc in docs}
+    cached = batch.get_many(CARDS_CACHE, list(keys.values()))
+
+    missing = [doc for doc in docs if keys[doc.id] not in cached]
+    hydrated = hydration.hydrate_documents([doc.id for doc in missing]) if missing else {}
+
+    cards = {}
+    for doc in docs:
+        card = cached.get(keys[doc.id])
+        if card is None:
+            card = make_card(doc, hydrated[doc.id])
+            batch.set(CARDS_CACHE, keys[doc.id], card, CARD_TIMEOUT)
+        cards[doc.id] = card
+    return cards
@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+# Description: Read-only access to the term embeddings written by scripts/clustering.py
+# Note: The matrix is memory-mapped, pages are shared between workers through the OS page cache
+
+import json
+import os
+
+import numpy as np
+
+EMBEDDINGS_DIR = 'term_embeddings/'
+MANIFEST_FILE = 'manifest.json'
+# Rows upcast to float32 at once while scoring, bounds the temporary memory
+SCORE_CHUNK_SIZE = 65536
+
+
+class TermEmbeddings:
+    """
+    Unit-norm embeddings of the vocabulary, one row per term, stored as float32, float16 or int8.
+
+    version: clustering run that produced the files
+    term_ids: term id of every row
+    matrix: read-only np.memmap of shape (n_terms, dim)
+    scales: per-row scale of an int8 matrix (embedding = matrix * scale), None for float matrices
+    """
+
+    def __init__(self, version, term_ids, matrix, scales=None):
+        self.version = version
+        self.term_ids = term_ids
+        self.matrix = matrix
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def scores(self, query_embedding, rows=None):
+        """
+        scores: cosine similarity between a unit-norm query embedding and the stored embeddings.
+        Args:
+            rows: sorted rows to score, all rows if None
+
+        Returns: float32 array aligned with rows
+        """
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        query_embedding = query_embedding.astype(np.float32, copy=False)
+        similarities = np.concatenate([
+            matrix[i:i + SCORE_CHUNK_SIZE].astype(np.float32, copy=False) @ query_embedding
+            for i in range(0, len(matrix), SCORE_CHUNK_SIZE)
+        ]) if len(matrix) else np.empty(0, dtype=np.float32)
+        if self.scales is not None:
+            similarities *= self.scales if rows is None else self.scales[rows]
+        return similarities
+
+    def nearest(self, query_embedding):
+        """
+        nearest: the term closest to a unit-norm query embedding by cosine similarity.
+        Returns: (term id, similarity), (None, 0.0) if the store is empty
+        """
+        if len(self) == 0:
+            return None, 0.0
+        similarities = self.scores(query_embedding)
+        row = int(np.argmax(similarities))
+        return int(self.term_ids[row]), float(similarities[row])
+
+
+def load_term_embeddings(directory=EMBEDDINGS_DIR):
+    """
+    load_term_embeddings: open the latest embedding files listed in the manifest.
+    Raises FileNotFoundError if the clustering script has not been run.
+    """
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    matrix = np.load(os.path.join(directory, manifest['embeddings']), mmap_mode='r')
+    term_ids = np.load(os.path.join(directory, manifest['term_ids']))
+    scales = np.load(os.path.join(directory, manifest['scales'])) if manifest.get('scales') else None
+    return TermEmbeddings(manifest['version'], term_ids, matrix, scales)
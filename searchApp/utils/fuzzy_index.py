@@ -0,0 +1,138 @@
+# -*- coding:utf-8 -*-
+# Description: Typo-tolerant term lookup with symmetric deletes (SymSpell), run before the semantic expansion
+# Note: Built from the vocabulary of the in-memory IndexEngine, together with every load of the engine
+
+import zlib
+
+import numpy as np
+
+MAX_EDIT_DISTANCE = 2
+# Words up to this length only accept one edit, two edits turn short words into almost anything
+SHORT_WORD_LENGTH = 4
+# Deletes are generated from this many leading characters only, which bounds the index size
+PREFIX_LENGTH = 7
+
+
+def _deletes(word, max_distance):
+    """
+    _deletes: every string obtained by deleting up to max_distance characters of the word prefix.
+    """
+    key = word[:PREFIX_LENGTH]
+    deletes = {key}
+    frontier = {key}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - deletes
+        deletes |= frontier
+    return deletes
+
+
+def _hash(text):
+    return zlib.crc32(text.encode())
+
+
+def edit_distance(a, b, max_distance):
+    """
+    edit_distance: optimal string alignment distance (insertion, deletion, substitution, adjacent transposition),
+    anything above max_distance is reported as max_distance + 1.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        # Later rows only grow from this row, or from the previous one through a transposition
+        if min(current) > max_distance and min(previous) >= max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class FuzzyIndex:
+    """
+    delete_hashes: sorted crc32 of the deletes of every term
+    delete_rows: term (row of `terms`) of every delete, aligned with delete_hashes
+    Hash collisions only add candidates, every candidate is verified with the real edit distance.
+    """
+
+    def __init__(self, terms, dfs):
+        self.terms = terms
+        self.dfs = dfs
+
+        hashes, rows = [], []
+        for row, term in enumerate(terms):
+            for delete in _deletes(term, MAX_EDIT_DISTANCE):
+                hashes.append(_hash(delete))
+                rows.append(row)
+        hashes = np.array(hashes, dtype=np.uint32)
+        order = np.argsort(hashes, kind='stable')
+        self.delete_hashes = hashes[order]
+        self.delete_rows = np.array(rows, dtype=np.int32)[order]
+
+    def lookup(self, word, k=1):
+        """
+        lookup: the closest terms to a word, by edit distance then df.
+        Returns: list of (term, distance), at most k
+        """
+        max_distance = 1 if len(word) <= SHORT_WORD_LENGTH else MAX_EDIT_DISTANCE
+        hashes = np.array([_hash(delete) for delete in _deletes(word, max_distance)], dtype=np.uint32)
+        starts = np.searchsorted(self.delete_hashes, hashes, side='left')
+        ends = np.searchsorted(self.delete_hashes, hashes, side='right')
+        if not (ends > starts).any():
+            return []
+        rows = np.unique(np.concatenate([self.delete_rows[s:e] for s, e in zip(starts, ends)]))
+
+        matches = []
+        for row in rows.tolist():
+            distance = edit_distance(word, self.terms[row], max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -int(self.dfs[row]), self.terms[row]))
+        matches.sort()
+        return [(term, distance) for distance, _, term in matches[:k]]
+
+
+_fuzzy = (None, None)
+
+
+def build_fuzzy_index(engine):
+    """
+    build_fuzzy_index: build the fuzzy index over the vocabulary of an IndexEngine and make it the current one,
+    called by index_engine when it loads an engine, before the engine serves any request.
+    """
+    global _fuzzy
+    index = FuzzyIndex(engine.term_texts, engine.term_dfs)
+    _fuzzy = (engine, index)
+    return index
+
+
+def get_fuzzy_index(engine):
+    """
+    get_fuzzy_index: the fuzzy index over the vocabulary of an IndexEngine.
+    Returns: the index, None for an engine already replaced by a reload (requests still in flight on it)
+    """
+    built_for, index = _fuzzy
+    return index if built_for is engine else None
+
+
+def correct_words(words, engine):
+    """
+    correct_words: replace the words missing from the vocabulary by their closest term.
+    Returns: (corrected words, True if any word was corrected)
+    """
+    index = None
+    corrected, changed = [], False
+    for word in words:
+        if engine.term_id(word) is None:
+            index = index or get_fuzzy_index(engine)
+            if index is None:
+                return words, False
+            matches = index.lookup(word)
+            if matches:
+                word, changed = matches[0][0], True
+        corrected.append(word)
+    return corrected, changed
@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+# Description: Batch loading of the related data shown on every result row
+# Note: Keyword ranking uses a window function, which requires MySQL 8.0+
+
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from searchApp.models import UrlLinkage, InvertedIndex
+
+KEYWORDS_PER_DOCUMENT = 5
+
+
+def hydrate_documents(doc_ids):
+    """
+    hydrate_documents: fetch parents, children and top keywords of many documents in three queries,
+    no matter how many documents are requested.
+    Args:
+        doc_ids: list of document ids
+
+    Returns: a dictionary doc_id -> {'from_docs': [...], 'to_docs': [...], 'keywords': [...]}
+
+    """
+    hydrated = {doc_id: {'from_docs': [], 'to_docs': [], 'keywords': []} for doc_id in doc_ids}
+    if not hydrated:
+        return hydrated
+
+    # Parents (pages linking to the document)
+    in_links = UrlLinkage.objects.filter(
+        to_document_id__in=doc_ids
+    ).order_by('id').values_list('to_document_id', 'from_document__url', 'from_document__title')
+    for doc_id, url, title in in_links:
+        hydrated[doc_id]['from_docs'].append({'url': url, 'title': title})
+
+    # Children (pages the document links to)
+    out_links = UrlLinkage.objects.filter(
+        from_document_id__in=doc_ids
+    ).order_by('id').values_list('from_document_id', 'to_document__url', 'to_document__title')
+    for doc_id, url, title in out_links:
+        hydrated[doc_id]['to_docs'].append({'url': url, 'title': title})
+
+    # Top keywords by tf, ranked per document inside MySQL
+    keywords = InvertedIndex.objects.filter(
+        document_id__in=doc_ids
+    ).annotate(
+        tf_rank=Window(RowNumber(), partition_by=F('document_id'), order_by=F('tf').desc())
+    ).filter(
+        tf_rank__lte=KEYWORDS_PER_DOCUMENT
+    ).order_by('document_id', 'tf_rank').values_list('document_id', 'term__term')
+    for doc_id, term in keywords:
+        hydrated[doc_id]['keywords'].append(term)
+
+    return hydrated
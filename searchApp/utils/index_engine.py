@@ -0,0 +1,280 @@
+# -*- coding:utf-8 -*-
+# Description: In-memory inverted index engine backed by NumPy posting arrays
+# Note: The index is loaded once per worker and reloaded when the index generation is bumped (scripts/index_generation.py).
+
+import threading
+
+import numpy as np
+
+from searchApp.models import Document, Term, InvertedIndex, CorpusStatistics
+from searchApp.utils import scoring, index_generation, fuzzy_index
+
+
+class IndexEngine:
+    """
+    An array-backed copy of the Term / InvertedIndex / Document tables.
+
+    Documents are addressed by "rows" (0 .. n_docs-1) instead of database ids, so that every per-document
+    attribute is a plain NumPy array indexed by row. Rows are ordered by static score (the PageRank + HITS part
+    of the ranking) descending, which lets top-k retrieval stop as soon as no remaining row can make the cut.
+
+    term_index: term string -> term id
+    term_texts: term strings aligned with term_ids
+    term_ids: sorted term ids, term_ids[i] owns the posting list stored in [offsets[i], offsets[i + 1])
+    term_dfs: document frequency aligned with term_ids
+    term_idfs: smoothed idf aligned with term_ids
+    posting_docs: document row of every posting, sorted inside each posting list
+    posting_tfs: term frequency of every posting
+    term_static_bounds: highest static score among the documents of each posting list, aligned with term_ids
+    term_max_impacts: highest tf * idf / document norm of each posting list, aligned with term_ids
+    doc_ids: database id of every document row
+    pr_scores, authority_scores, hub_scores: link analysis scores aligned with doc_ids
+    static_scores: query independent part of the ranking score aligned with doc_ids (descending)
+    doc_norms, doc_lengths: norm of the full TF-IDF vector and number of tokens, aligned with doc_ids
+    stats_version, avg_doc_length: from the latest CorpusStatistics record (scripts/corpus_stats.py),
+        stats_version is None when the statistics have never been computed
+    generation: index generation (utils/index_generation.py) read before loading, any other one means this copy is stale
+    """
+
+    def __init__(self):
+        self.term_index = {}
+        self.term_texts = []
+        self.term_ids = np.empty(0, dtype=np.int64)
+        self.term_dfs = np.empty(0, dtype=np.int32)
+        self.term_idfs = np.empty(0, dtype=np.float64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.posting_docs = np.empty(0, dtype=np.int32)
+        self.posting_tfs = np.empty(0, dtype=np.int32)
+        self.term_static_bounds = np.empty(0, dtype=np.float64)
+        self.term_max_impacts = np.empty(0, dtype=np.float64)
+
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.pr_scores = np.empty(0, dtype=np.float64)
+        self.authority_scores = np.empty(0, dtype=np.float64)
+        self.hub_scores = np.empty(0, dtype=np.float64)
+        self.static_scores = np.empty(0, dtype=np.float64)
+        self.doc_norms = np.empty(0, dtype=np.float64)
+        self.doc_lengths = np.empty(0, dtype=np.int64)
+
+        self.stats_version = None
+        self.avg_doc_length = 0.0
+        self.generation = 0
+
+    @property
+    def n_docs(self):
+        return len(self.doc_ids)
+
+    def load(self):
+        """
+        load: read the whole inverted index from MySQL. This is the only place the engine touches the database.
+        """
+        # Read first, changes committed while loading make the next request reload again rather than never
+        self.generation = index_generation.current_generation()
+
+        stats = CorpusStatistics.objects.order_by('-version').first()
+        if stats is not None:
+            self.stats_version = stats.version
+            self.avg_doc_length = stats.avg_doc_length
+
+        docs = list(Document.objects.order_by('id').values_list(
+            'id', 'pr_score', 'authority_score', 'hub_score', 'tfidf_norm', 'doc_length'
+        ))
+        doc_table = np.array(docs, dtype=np.float64).reshape(-1, 6)
+        sorted_doc_ids = doc_table[:, 0].astype(np.int64)
+        self.doc_ids = sorted_doc_ids
+        self.pr_scores = doc_table[:, 1]
+        self.authority_scores = doc_table[:, 2]
+        self.hub_scores = doc_table[:, 3]
+
+        # Reorder document rows by static score
+        static, _ = scoring.static_scores(self, np.arange(len(sorted_doc_ids)))
+        order = np.argsort(-static, kind='stable')
+        id_rank_to_row = np.empty(len(order), dtype=np.int64)
+        id_rank_to_row[order] = np.arange(len(order))
+        self.doc_ids = sorted_doc_ids[order]
+        self.pr_scores = self.pr_scores[order]
+        self.authority_scores = self.authority_scores[order]
+        self.hub_scores = self.hub_scores[order]
+        self.static_scores = static[order]
+        self.doc_norms = doc_table[order, 4]
+        self.doc_lengths = doc_table[order, 5].astype(np.int64)
+
+        terms = list(Term.objects.order_by('id').values_list('id', 'term', 'df', 'idf'))
+        self.term_ids = np.array([t[0] for t in terms], dtype=np.int64)
+        self.term_dfs = np.array([t[2] for t in terms], dtype=np.int32)
+        self.term_idfs = np.array([t[3] for t in terms], dtype=np.float64)
+        self.term_texts = [t[1] for t in terms]
+        self.term_index = {t[1]: t[0] for t in terms}
+
+        postings = InvertedIndex.objects.order_by('term_id', 'document_id').values_list('term_id', 'document_id', 'tf')
+        posting_table = np.array(list(postings), dtype=np.int64).reshape(-1, 3)
+
+        # Drop postings pointing to terms or documents that appeared after the snapshot above
+        term_rows = np.searchsorted(self.term_ids, posting_table[:, 0])
+        id_ranks = np.searchsorted(sorted_doc_ids, posting_table[:, 1])
+        valid = (term_rows < len(self.term_ids)) & (id_ranks < len(sorted_doc_ids))
+        valid[valid] &= (self.term_ids[term_rows[valid]] == posting_table[valid, 0]) & \
+                        (sorted_doc_ids[id_ranks[valid]] == posting_table[valid, 1])
+
+        term_rows = term_rows[valid]
+        doc_rows = id_rank_to_row[id_ranks[valid]]
+        tfs = posting_table[valid, 2]
+        by_term_then_row = np.lexsort((doc_rows, term_rows))
+        self.posting_docs = doc_rows[by_term_then_row].astype(np.int32)
+        self.posting_tfs = tfs[by_term_then_row].astype(np.int32)
+        counts = np.bincount(term_rows, minlength=len(self.term_ids))
+        self.offsets = np.zeros(len(self.term_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+        self._fill_missing_statistics(term_rows[by_term_then_row], counts)
+
+        # Upper bounds per term used by top-k retrieval
+        # the first posting of a list is its best static document
+        self.term_static_bounds = np.zeros(len(self.term_ids), dtype=np.float64)
+        self.term_max_impacts = np.zeros(len(self.term_ids), dtype=np.float64)
+        non_empty = counts > 0
+        starts = self.offsets[:-1][non_empty]
+        self.term_static_bounds[non_empty] = self.static_scores[self.posting_docs[starts]]
+        if len(starts):
+            impacts = self.posting_tfs * self.term_idfs[term_rows[by_term_then_row]] / self.doc_norms[self.posting_docs]
+            self.term_max_impacts[non_empty] = np.maximum.reduceat(impacts, starts)
+
+        return self
+
+    def _fill_missing_statistics(self, posting_term_rows, dfs):
+        """
+        _fill_missing_statistics: compute idf and document norms that scripts/corpus_stats.py has not stored yet
+        (never run, or terms / documents added by a crawl after its last run), with the same formulas.
+        """
+        missing_idf = self.term_idfs <= 0
+        if missing_idf.any():
+            self.term_idfs[missing_idf] = scoring.smooth_idf(self.n_docs, dfs[missing_idf])
+
+        missing_norm = self.doc_norms <= 0
+        if missing_norm.any():
+            weights = (self.posting_tfs * self.term_idfs[posting_term_rows]) ** 2
+            norms = np.sqrt(np.bincount(self.posting_docs, weights=weights, minlength=self.n_docs))
+            lengths = np.bincount(self.posting_docs, weights=self.posting_tfs, minlength=self.n_docs)
+            self.doc_norms[missing_norm] = norms[missing_norm]
+            self.doc_lengths[missing_norm] = lengths[missing_norm].astype(np.int64)
+
+        if self.stats_version is None and self.n_docs:
+            self.avg_doc_length = float(self.doc_lengths.mean())
+
+    def term_id(self, term):
+        return self.term_index.get(term)
+
+    def term_text(self, term_id):
+        row = self._term_row(term_id)
+        return self.term_texts[row] if row >= 0 else None
+
+    def _term_row(self, term_id):
+        row = int(np.searchsorted(self.term_ids, term_id))
+        if row < len(self.term_ids) and self.term_ids[row] == term_id:
+            return row
+        return -1
+
+    def static_bound(self, term_id):
+        row = self._term_row(term_id)
+        return float(self.term_static_bounds[row]) if row >= 0 else 0.0
+
+    def max_impact(self, term_id):
+        row = self._term_row(term_id)
+        return float(self.term_max_impacts[row]) if row >= 0 else 0.0
+
+    def idf(self, term_id):
+        row = self._term_row(term_id)
+        return float(self.term_idfs[row]) if row >= 0 else 0.0
+
+    def df(self, term_id):
+        row = self._term_row(term_id)
+        return int(self.term_dfs[row]) if row >= 0 else 0
+
+    def postings(self, term_id):
+        """
+        postings: posting list of a term.
+        Returns: (document rows, term frequencies), both sorted by document row.
+        """
+        row = self._term_row(term_id)
+        if row < 0:
+            return self.posting_docs[:0], self.posting_tfs[:0]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.posting_docs[start:end], self.posting_tfs[start:end]
+
+    def candidates(self, term_ids):
+        """
+        candidates: rows of all documents containing at least one of the terms (sorted, deduplicated).
+        """
+        lists = [self.postings(tid)[0] for tid in term_ids]
+        if not lists:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(lists))
+
+    def tf_matrix(self, term_ids, doc_rows):
+        """
+        tf_matrix: dense tf lookup for a set of documents.
+        Args:
+            term_ids: list of term ids (columns)
+            doc_rows: sorted array of document rows (rows)
+
+        Returns: array of shape (len(doc_rows), len(term_ids)), 0 where the term does not occur.
+        """
+        matrix = np.zeros((len(doc_rows), len(term_ids)), dtype=np.int32)
+        for col, tid in enumerate(term_ids):
+            p_docs, p_tfs = self.postings(tid)
+            if len(p_docs) == 0:
+                continue
+            pos = np.searchsorted(p_docs, doc_rows)
+            pos[pos == len(p_docs)] = 0
+            hit = p_docs[pos] == doc_rows
+            matrix[hit, col] = p_tfs[pos[hit]]
+        return matrix
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_reload_lock = threading.Lock()
+
+
+def get_engine(generation=None):
+    """
+    get_engine: the process-wide engine, loaded on first use.
+    Args:
+        generation: the current index generation if known. An engine of another generation is reloaded in the
+            background and keeps serving requests until the new one is swapped in. The counter restarts from 0 when
+            Redis loses it, so a lower generation means a reload too.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _load_engine()
+    elif generation is not None and _engine.generation != generation and _reload_lock.acquire(blocking=False):
+        threading.Thread(target=_reload_in_background, daemon=True).start()
+    return _engine
+
+
+def _reload_in_background():
+    try:
+        reload_engine()
+    finally:
+        _reload_lock.release()
+
+
+def reload_engine():
+    """
+    reload_engine: rebuild the engine from MySQL and swap it in atomically, requests in flight keep the old copy.
+    """
+    global _engine
+    engine = _load_engine()
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+
+def _load_engine():
+    # Misspelled queries are ranked (and cached) without correction when the engine has no fuzzy index yet,
+    # so it is built before the engine serves any request
+    engine = IndexEngine().load()
+    fuzzy_index.build_fuzzy_index(engine)
+    return engine
@@ -0,0 +1,30 @@
+# -*- coding:utf-8 -*-
+# Description: Generation number of the index, cached searches are namespaced by it
+# Note: Bumped by scripts/index_generation.py at the end of the spider and of the ranking scripts
+
+import time
+
+from django_redis import get_redis_connection
+
+# Redis connection (cache alias) holding the counter, written with a plain INCR so it is not a pickled cache value
+GENERATION_CACHE = 'default'
+GENERATION_KEY = 'index_generation'
+# Seconds a worker trusts the generation it read last, bounds how long a bump goes unnoticed
+GENERATION_CHECK_INTERVAL = 1
+
+# (time.monotonic() of the last read, generation read)
+_checked = (None, 0)
+
+
+def current_generation():
+    """
+    current_generation: the latest index generation, 0 if the index has never been rebuilt since Redis started.
+    """
+    global _checked
+    checked_at, generation = _checked
+    now = time.monotonic()
+    if checked_at is None or now - checked_at >= GENERATION_CHECK_INTERVAL:
+        value = get_redis_connection(GENERATION_CACHE).get(GENERATION_KEY)
+        generation = int(value) if value is not None else 0
+        _checked = (now, generation)
+    return generation
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+# Description: Morphological query expansion (plural, gerund, past tense...) against the indexed vocabulary
+# Note: The expansion table is built by scripts/term_expansion.py, words it does not cover go through lemminflect
+
+import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+import joblib
+from lemminflect import getAllLemmas, getInflection
+
+EXPANSION_FILE = 'term_expansion.pkl'
+# Words missing from the expansion table whose inflections are kept in memory
+EXPANSION_CACHE_SIZE = 4096
+
+QueryTerm = namedtuple('QueryTerm', ['id', 'term'])
+
+
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def inflected_forms(term):
+    """
+    inflected_forms: the word itself, the plural of its noun lemmas and the inflections of its verb lemmas.
+    Returns: a tuple of lower-cased forms
+    """
+    expanded_terms = {term.lower()}
+
+    lemmas = getAllLemmas(term)
+    for pos in lemmas:
+        for lemma in lemmas[pos]:
+            if pos == 'NOUN':
+                plural = getInflection(lemma, 'NNS')
+                if plural:
+                    expanded_terms.add(plural[0].lower())
+
+            elif pos == 'VERB':
+                # Gerund (filming), past tense (filmed), past participle (filmed), 3rd person singular (films)
+                for tag in ('VBG', 'VBD', 'VBN', 'VBZ'):
+                    forms = getInflection(lemma, tag)
+                    if forms:
+                        expanded_terms.update(f.lower() for f in forms)
+
+    return tuple(sorted(expanded_terms))
+
+
+# (modification time of the file, corpus statistics version, table)
+_expansion = (None, None, {})
+_expansion_lock = threading.Lock()
+
+
+def load_expansion_table(path=EXPANSION_FILE):
+    """
+    load_expansion_table: read the precomputed table, surface form -> tuple of term ids.
+    Returns: (CorpusStatistics version the table was built after, table), (None, {}) if it has not been built
+    """
+    try:
+        table = joblib.load(path)
+    except FileNotFoundError:
+        return None, {}
+    return table.get('stats_version'), table['expansion']
+
+
+def get_expansion_table(path=EXPANSION_FILE):
+    """
+    get_expansion_table: the table of this worker, loaded again whenever scripts/term_expansion.py rewrites the file.
+    Returns: (CorpusStatistics version, table)
+    """
+    global _expansion
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _expansion[0]:
+        with _expansion_lock:
+            if mtime != _expansion[0]:
+                _expansion = (mtime,) + load_expansion_table(path)
+    return _expansion[1], _expansion[2]
+
+
+def expand_words(words, engine):
+    """
+    expand_words: the indexed terms matching the words of a query or one of their inflections.
+    Args:
+        words: lower-cased query words
+        engine: IndexEngine, its vocabulary is the source of truth
+
+    Returns: a list of QueryTerm(id, term) without duplicates
+
+    """
+    stats_version, table = get_expansion_table()
+    # A table built over another vocabulary (older crawl) may point to missing terms or miss new ones
+    if stats_version is None or stats_version != engine.stats_version:
+        table = {}
+
+    term_ids = {}
+    for word in words:
+        if word in table:
+            term_ids.update(dict.fromkeys(table[word]))
+        else:
+            for form in inflected_forms(word):
+                term_id = engine.term_id(form)
+                if term_id is not None:
+                    term_ids[term_id] = None
+
+    return [QueryTerm(term_id, engine.term_text(term_id)) for term_id in term_ids]
@@ -0,0 +1,175 @@
+# -*- coding:utf-8 -*-
+# Description: Reader of the compact positional index (PositionalIndex blobs)
+# Note: Blobs are written by Spider/utils/DBHelper.encode_positions, positions start from 1
+
+import heapq
+from bisect import bisect_left
+
+import numpy as np
+
+from searchApp.models import PositionalIndex
+from searchApp.utils import index_engine, posting_cache
+
+# Proximity only looks at the first positions of every term in a document
+MAX_PROXIMITY_POSITIONS = 512
+
+
+def decode_positions(blob):
+    """
+    decode_positions: decode a delta + varint blob without a Python loop over its bytes.
+    Args:
+        blob: bytes (or memoryview) from PositionalIndex.positions
+
+    Returns: ascending positions as an int64 array
+
+    """
+    return posting_cache.decode_many([blob])[1]
+
+
+def fetch_positions(term_ids, doc_ids):
+    """
+    fetch_positions: positions of many terms in many documents, from the term posting cache,
+    with a single query for the terms it does not hold (yet).
+    Args:
+        term_ids: list of term ids
+        doc_ids: list of document ids
+
+    Returns: a dictionary doc_id -> {term_id: positions array}, terms missing from a document are left out
+
+    """
+    positions = {doc_id: {} for doc_id in doc_ids}
+    if not term_ids or not doc_ids:
+        return positions
+
+    cached = posting_cache.get_posting_cache(index_engine.get_engine()).get_many(list(dict.fromkeys(term_ids)))
+    for term_id, term_positions in cached.items():
+        for doc_id, found in term_positions.lookup(doc_ids).items():
+            positions[doc_id][term_id] = found
+
+    uncached = [term_id for term_id in term_ids if term_id not in cached]
+    if not uncached:
+        return positions
+    rows = PositionalIndex.objects.filter(
+        term_id__in=uncached, document_id__in=doc_ids
+    ).values_list('document_id', 'term_id', 'positions')
+    for doc_id, term_id, blob in rows:
+        positions[doc_id][term_id] = decode_positions(blob)
+    return positions
+
+
+def gallop_intersect(small, large):
+    """
+    gallop_intersect: intersection of two ascending lists, galloping (exponential search) through the larger one,
+    so the cost grows with the smaller list instead of the sum of both.
+    """
+    result = []
+    lo, n = 0, len(large)
+    for x in small:
+        if lo >= n:
+            break
+        bound = 1
+        while lo + bound < n and large[lo + bound] < x:
+            bound *= 2
+        lo = bisect_left(large, x, lo + bound // 2, min(lo + bound + 1, n))
+        if lo < n and large[lo] == x:
+            result.append(x)
+            lo += 1
+    return result
+
+
+def phrase_starts(position_lists):
+    """
+    phrase_starts: positions where a phrase starts.
+    Args:
+        position_lists: ascending positions of every phrase word in one document, in phrase order
+
+    Returns: list of start positions, empty if the phrase does not occur
+
+    """
+    # Start from the rarest word, and keep only starts that every other word confirms at its offset
+    order = sorted(range(len(position_lists)), key=lambda i: len(position_lists[i]))
+    first = order[0]
+    starts = [p - first for p in position_lists[first]]
+    for i in order[1:]:
+        if not starts:
+            break
+        starts = [p - i for p in gallop_intersect([s + i for s in starts], position_lists[i])]
+    return starts
+
+
+def min_window_span(position_lists):
+    """
+    min_window_span: length (in tokens) of the smallest window containing one position of every list.
+    """
+    heap = [(positions[0], i, 0) for i, positions in enumerate(position_lists) if len(positions)]
+    if len(heap) < len(position_lists):
+        return None
+    heapq.heapify(heap)
+    window_end = max(entry[0] for entry in heap)
+    best = window_end - heap[0][0] + 1
+
+    while True:
+        position, i, j = heapq.heappop(heap)
+        best = min(best, window_end - position + 1)
+        if j + 1 == len(position_lists[i]):
+            return best
+        following = position_lists[i][j + 1]
+        window_end = max(window_end, following)
+        heapq.heappush(heap, (following, i, j + 1))
+
+
+def phrase_documents(engine, phrases):
+    """
+    phrase_documents: rows of the documents containing every phrase.
+    Args:
+        engine: IndexEngine
+        phrases: list of phrases, each a list of term ids in phrase order (None for a word out of vocabulary)
+
+    Returns: sorted array of document rows
+
+    """
+    rows = None
+    for phrase in phrases:
+        if any(term_id is None for term_id in phrase):
+            return np.empty(0, dtype=np.int32)
+
+        # Documents containing all words of the phrase, rarest posting list first
+        lists = sorted((engine.postings(term_id)[0] for term_id in set(phrase)), key=len)
+        docs = lists[0]
+        for posting_docs in lists[1:]:
+            docs = np.intersect1d(docs, posting_docs, assume_unique=True)
+
+        # Then the words must be adjacent
+        if len(phrase) > 1 and len(docs):
+            doc_ids = engine.doc_ids[docs].tolist()
+            positions = fetch_positions(list(set(phrase)), doc_ids)
+            matched = [
+                len(positions[doc_id]) == len(set(phrase)) and
+                len(phrase_starts([positions[doc_id][term_id].tolist() for term_id in phrase])) > 0
+                for doc_id in doc_ids
+            ]
+            docs = docs[np.array(matched, dtype=bool)]
+
+        rows = docs if rows is None else np.intersect1d(rows, docs, assume_unique=True)
+
+    return rows if rows is not None else np.empty(0, dtype=np.int32)
+
+
+def proximity_spans(term_ids, doc_ids, max_positions=MAX_PROXIMITY_POSITIONS):
+    """
+    proximity_spans: how close the query terms appear in each document.
+    Args:
+        term_ids: distinct query term ids
+        doc_ids: list of document ids
+        max_positions: positions kept per term and document, bounds the cost of a document
+
+    Returns: a dictionary doc_id -> (number of query terms present, smallest window covering them)
+
+    """
+    spans = {}
+    for doc_id, term_positions in fetch_positions(term_ids, doc_ids).items():
+        if len(term_positions) < 2:
+            continue
+        lists = [positions[:max_positions].tolist() for positions in term_positions.values()]
+        spans[doc_id] = (len(lists), min_window_span(lists))
+    return spans
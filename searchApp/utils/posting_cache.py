@@ -0,0 +1,244 @@
+# -*- coding:utf-8 -*-
+# Description: Term-level cache of decoded positional postings, shared by every query using the term
+# Note: Document postings and idf already live in the IndexEngine, positions were the per-query database work.
+#       Rebuilt with the engine, optionally shared between workers through Redis (POSTING_CACHE_REDIS in settings)
+
+import heapq
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from searchApp.models import PositionalIndex
+
+# Bytes of decoded positions each worker keeps
+POSTING_CACHE_BYTES = 256 * 1024 * 1024
+# Terms in more documents than this are never cached whole, their positions are fetched per query
+MAX_CACHED_DF = 5000
+# Fetching a term costs about one round-trip on top of its size, this favours keeping small terms
+FETCH_COST_BYTES = 16 * 1024
+REMOTE_CACHE = 'default'
+REMOTE_TIMEOUT = 24 * 60 * 60
+HEADER_DTYPE = np.dtype('<i8')
+
+
+def decode_many(blobs):
+    """
+    decode_many: decode a list of delta + varint blobs (Spider/utils/DBHelper.encode_positions) in one pass,
+    without a Python loop over their bytes.
+    Args:
+        blobs: list of bytes (or memoryview) from PositionalIndex.positions or TokenOffsets.offsets
+
+    Returns: (offsets, positions), positions of blobs[i] are positions[offsets[i]:offsets[i + 1]] (int64 arrays)
+    """
+    lengths = np.array([len(blob) for blob in blobs], dtype=np.int64)
+    data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    if len(data) == 0:
+        return offsets, np.empty(0, dtype=np.int64)
+
+    # A byte without the continuation bit closes a value
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    value_of_byte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = 7 * (np.arange(len(data)) - starts[value_of_byte])
+    payload = (data & 0x7F).astype(np.int64) << shifts
+    deltas = np.bincount(value_of_byte, weights=payload, minlength=len(ends)).astype(np.int64)
+
+    # Deltas restart with every blob
+    offsets[1:] = np.searchsorted(ends, np.cumsum(lengths), side='left')
+    totals = np.cumsum(deltas)
+    bases = np.concatenate([[0], totals])[offsets[:-1]]
+    return offsets, totals - np.repeat(bases, np.diff(offsets))
+
+
+class TermPositions:
+    """
+    doc_ids: sorted ids of the documents containing the term
+    offsets: positions in doc_ids[i] are positions[offsets[i]:offsets[i + 1]]
+    positions: concatenated ascending positions
+    """
+
+    def __init__(self, doc_ids, offsets, positions):
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.positions = positions
+
+    @property
+    def nbytes(self):
+        return self.doc_ids.nbytes + self.offsets.nbytes + self.positions.nbytes
+
+    def lookup(self, doc_ids):
+        """
+        lookup: positions of the term in some documents.
+        Returns: a dictionary doc_id -> positions array, documents without the term are left out
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        rows = np.searchsorted(self.doc_ids, doc_ids)
+        rows[rows == len(self.doc_ids)] = 0
+        found = {}
+        if len(self.doc_ids) == 0:
+            return found
+        for doc_id, row in zip(doc_ids.tolist(), rows.tolist()):
+            if self.doc_ids[row] == doc_id:
+                found[doc_id] = self.positions[self.offsets[row]:self.offsets[row + 1]]
+        return found
+
+    def to_bytes(self):
+        header = np.array([len(self.doc_ids), len(self.positions)], dtype=HEADER_DTYPE)
+        return header.tobytes() + self.doc_ids.tobytes() + self.offsets.tobytes() + self.positions.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        n_docs, n_positions = np.frombuffer(data, dtype=HEADER_DTYPE, count=2).tolist()
+        start = 2 * HEADER_DTYPE.itemsize
+        doc_ids = np.frombuffer(data, dtype=np.int64, count=n_docs, offset=start)
+        start += doc_ids.nbytes
+        offsets = np.frombuffer(data, dtype=np.int64, count=n_docs + 1, offset=start)
+        start += offsets.nbytes
+        positions = np.frombuffer(data, dtype=np.int32, count=n_positions, offset=start)
+        return cls(doc_ids, offsets, positions)
+
+
+def load_term_positions(term_ids):
+    """
+    load_term_positions: every position of some terms, with a single query.
+    Returns: a dictionary term_id -> TermPositions
+    """
+    rows = PositionalIndex.objects.filter(term_id__in=term_ids).order_by(
+        'term_id', 'document_id'
+    ).values_list('term_id', 'document_id', 'positions')
+    by_term = {term_id: ([], []) for term_id in term_ids}
+    for term_id, doc_id, blob in rows:
+        by_term[term_id][0].append(doc_id)
+        by_term[term_id][1].append(blob)
+
+    loaded = {}
+    for term_id, (doc_ids, blobs) in by_term.items():
+        offsets, positions = decode_many(blobs)
+        loaded[term_id] = TermPositions(np.array(doc_ids, dtype=np.int64), offsets, positions.astype(np.int32))
+    return loaded
+
+
+class PostingCache:
+    """
+    Greedy-Dual-Size-Frequency eviction: an entry's priority is the clock at its last access plus
+    frequency * fetch cost / size, the lowest priority is evicted and the clock moves up to it. Frequently used
+    and cheap to keep terms stay, large rarely used ones go first, and entries idle for long age out.
+
+    entries: term_id -> [TermPositions, access frequency, priority]
+    heap: (priority, term_id), entries whose priority changed since are skipped when popped,
+        rebuilt from the entries once stale items outnumber them
+    loading: terms being loaded in the background
+    """
+
+    def __init__(self, engine, max_bytes=POSTING_CACHE_BYTES):
+        self.engine = engine
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.heap = []
+        self.clock = 0.0
+        self.size = 0
+        self.loading = set()
+        self.lock = threading.Lock()
+
+    def _priority(self, positions, frequency):
+        return self.clock + frequency * (FETCH_COST_BYTES + positions.nbytes) / max(positions.nbytes, 1)
+
+    def _touch(self, term_id):
+        entry = self.entries[term_id]
+        entry[1] += 1
+        entry[2] = self._priority(entry[0], entry[1])
+        heapq.heappush(self.heap, (entry[2], term_id))
+        # Stale heap items pile up with every access
+        if len(self.heap) > 4 * len(self.entries) + 64:
+            self.heap = [(entry[2], tid) for tid, entry in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def _add(self, term_id, positions):
+        if term_id in self.entries or positions.nbytes > self.max_bytes:
+            return
+        self.entries[term_id] = [positions, 0, 0.0]
+        self.size += positions.nbytes
+        self._touch(term_id)
+        while self.size > self.max_bytes:
+            priority, victim = heapq.heappop(self.heap)
+            entry = self.entries.get(victim)
+            if entry is None or entry[2] != priority:
+                continue
+            del self.entries[victim]
+            self.size -= entry[0].nbytes
+            self.clock = priority
+
+    def _remote_key(self, term_id):
+        return f'postings:{self.engine.generation}:{term_id}'
+
+    def get_many(self, term_ids):
+        """
+        get_many: positions of the cached terms. The missing terms up to MAX_CACHED_DF are loaded in the background,
+        callers fetch the positions they need per query meanwhile.
+        Returns: a dictionary term_id -> TermPositions, terms not cached yet are left out
+        """
+        found = {}
+        with self.lock:
+            for term_id in term_ids:
+                if term_id in self.entries:
+                    self._touch(term_id)
+                    found[term_id] = self.entries[term_id][0]
+            missing = [tid for tid in term_ids if tid not in found and tid not in self.loading and
+                       self.engine.df(tid) <= MAX_CACHED_DF]
+            self.loading.update(missing)
+        if missing:
+            threading.Thread(target=self._load_in_background, args=(missing,), daemon=True).start()
+        return found
+
+    def _load_in_background(self, term_ids):
+        try:
+            self.load(term_ids)
+        finally:
+            with self.lock:
+                self.loading.difference_update(term_ids)
+            # The thread has its own database connection
+            connection.close()
+
+    def load(self, term_ids):
+        """
+        load: add the positions of some terms to the cache, from Redis or MySQL.
+        Returns: a dictionary term_id -> TermPositions
+        """
+        loaded = {}
+        if settings.POSTING_CACHE_REDIS:
+            remote = caches[REMOTE_CACHE]
+            keys = {self._remote_key(tid): tid for tid in term_ids}
+            for key, data in remote.get_many(list(keys)).items():
+                loaded[keys[key]] = TermPositions.from_bytes(data)
+        from_database = load_term_positions([tid for tid in term_ids if tid not in loaded])
+        if settings.POSTING_CACHE_REDIS and from_database:
+            remote.set_many({self._remote_key(tid): positions.to_bytes() for tid, positions in from_database.items()},
+                            timeout=REMOTE_TIMEOUT)
+        loaded.update(from_database)
+
+        with self.lock:
+            for term_id, positions in loaded.items():
+                self._add(term_id, positions)
+        return loaded
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_posting_cache(engine):
+    """
+    get_posting_cache: the posting cache of an IndexEngine, replaced when the engine is reloaded.
+    """
+    global _cache
+    if _cache is None or _cache.engine is not engine:
+        with _cache_lock:
+            if _cache is None or _cache.engine is not engine:
+                _cache = PostingCache(engine)
+    return _cache
@@ -0,0 +1,108 @@
+# -*- coding:utf-8 -*-
+# Description: Query term encoder with an LRU cache and micro-batching of concurrent requests
+# Note: One background thread per worker process runs every encode call of the model
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+# Encoded terms kept in memory
+ENCODER_CACHE_SIZE = 10000
+# Time (seconds) the batching thread waits for more terms before calling the model, and batch size limit
+BATCH_WINDOW = 0.005
+MAX_BATCH_SIZE = 64
+
+
+def normalize_text(text):
+    return ' '.join(text.lower().split())
+
+
+class BatchingEncoder:
+    """
+    Wraps a SentenceTransformer: returns unit-norm embeddings, caches them by normalized text, and coalesces the
+    cache misses of concurrent requests into one model.encode call per batch window.
+    Identical texts requested at the same time share one pending result.
+    """
+
+    def __init__(self, model, cache_size=ENCODER_CACHE_SIZE, batch_window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE):
+        self.model = model
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+
+        self._cache = OrderedDict()
+        self._pending = OrderedDict()  # normalized text -> Future, in arrival order
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def encode(self, texts):
+        """
+        encode: unit-norm embeddings of texts.
+        Returns: float32 array of shape (len(texts), dim)
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        keys = [normalize_text(text) for text in texts]
+        results = {}
+        waiting = {}
+
+        with self._condition:
+            for key in keys:
+                if key in results or key in waiting:
+                    continue
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    results[key] = self._cache[key]
+                elif key in self._pending:
+                    waiting[key] = self._pending[key]
+                else:
+                    waiting[key] = self._pending[key] = Future()
+
+            if waiting:
+                self._ensure_thread()
+                self._condition.notify()
+
+        for key, future in waiting.items():
+            results[key] = future.result()
+
+        return np.array([results[key] for key in keys], dtype=np.float32)
+
+    def _ensure_thread(self):
+        # The thread does not survive a fork (gunicorn workers), start one in every process that encodes
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='batching-encoder', daemon=True)
+            self._thread.start()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+        # Let concurrent requests join the batch
+        time.sleep(self.batch_window)
+        with self._condition:
+            keys = list(self._pending)[:self.max_batch_size]
+            return [(key, self._pending.pop(key)) for key in keys]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                embeddings = np.asarray(self.model.encode([key for key, _ in batch]), dtype=np.float32)
+                norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+                embeddings = embeddings / np.where(norms > 0, norms, 1)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._condition:
+                for (key, _), embedding in zip(batch, embeddings):
+                    self._cache[key] = embedding
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+# Description: Search result cache holding compact rankings under normalized, generation-namespaced keys
+# Note: Only document ids and scores are cached, every request composes its page from them
+
+import hashlib
+
+import numpy as np
+
+from searchApp.utils import tiered_cache
+
+RESULTS_CACHE = 'search_results'
+RESULTS_TIMEOUT = 60 * 60
+# One row of a ranking, 20 bytes instead of a json list of four numbers
+RANKING_DTYPE = np.dtype([('doc_id', '<i8'), ('final', '<f4'), ('relevance', '<f4'), ('hits', '<f4')])
+
+
+def normalize_query(words, phrases):
+    """
+    normalize_query: canonical text of a query. Word order, repeated words and spacing do not change the ranking,
+    quoted phrases are kept as phrases.
+    Args:
+        words: lower-cased words of the query
+        phrases: quoted phrases, each a list of lower-cased words
+
+    Returns: normalized query string
+    """
+    normalized_phrases = sorted('"' + ' '.join(phrase) + '"' for phrase in phrases)
+    return ' '.join(sorted(set(words)) + normalized_phrases)
+
+
+def ranking_key(generation, words, phrases):
+    """
+    ranking_key: cache key of a query ranked by the index of the given generation.
+    """
+    digest = hashlib.sha1(normalize_query(words, phrases).encode()).hexdigest()
+    return f'search:{generation}:{digest}'
+
+
+def get_ranking(key, batch=None):
+    """
+    get_ranking: a cached rank_query() result.
+    Args:
+        key: from ranking_key()
+        batch: optional cache_batch.CacheBatch of the request
+
+    Returns: dictionary with 'ranking' as a RANKING_DTYPE array, None on a miss
+    """
+    if batch is not None:
+        cached = batch.get(RESULTS_CACHE, key)
+    else:
+        cached = tiered_cache.get_cache(RESULTS_CACHE).get(key)
+    if cached is None:
+        return None
+    ranked = dict(cached)
+    ranked['ranking'] = np.frombuffer(cached['ranking'], dtype=RANKING_DTYPE)
+    return ranked
+
+
+def set_ranking(key, ranked, batch=None, timeout=RESULTS_TIMEOUT):
+    """
+    set_ranking: cache a rank_query() result, the ranking is stored as raw bytes.
+    With a batch, the value is written by its next flush().
+    """
+    packed = dict(ranked)
+    packed['ranking'] = np.ascontiguousarray(ranked['ranking'], dtype=RANKING_DTYPE).tobytes()
+    if batch is not None:
+        batch.set(RESULTS_CACHE, key, packed, timeout)
+    else:
+        tiered_cache.get_cache(RESULTS_CACHE).set(key, packed, timeout=timeout)
@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+# Description: Vectorized TF-IDF / PageRank / HITS ranking over the in-memory index
+# Note:
+
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+# Magic number: compute final ranking score as 0.7 * tf/idf + 0.2 * pagerank + 0.1 * HITS
+# TODO: Fine-tune Weight Params
+TFIDF_WEIGHT = 0.7
+PAGERANK_WEIGHT = 0.2
+HITS_WEIGHT = 0.1
+# Added on top of the blend for documents where the query terms appear close to each other
+PROXIMITY_WEIGHT = 0.1
+
+# Top-k retrieval walks the document rows in blocks of this size
+TOP_K_BLOCK_SIZE = 4096
+
+ScoredDocuments = namedtuple('ScoredDocuments', ['doc_rows', 'doc_ids', 'final', 'relevance', 'hits'])
+
+
+def smooth_idf(total_docs, dfs):
+    return np.log((total_docs + 1) / (np.asarray(dfs, dtype=np.float64) + 1)) + 1
+
+
+def static_scores(engine, doc_rows):
+    """
+    static_scores: the query independent part of the ranking score.
+    Returns: (weighted pagerank + HITS part, raw HITS score)
+    """
+    hits = (engine.authority_scores[doc_rows] + engine.hub_scores[doc_rows]) / 2.0
+    return PAGERANK_WEIGHT * engine.pr_scores[doc_rows] + HITS_WEIGHT * hits, hits
+
+
+def _cosine(dots, doc_norms, query_norm):
+    """
+    _cosine: cosine between the documents (full TF-IDF vectors, norms precomputed at index time) and the query.
+    """
+    relevance = np.zeros(len(dots), dtype=np.float64)
+    nonzero = doc_norms != 0
+    relevance[nonzero] = dots[nonzero] / (doc_norms[nonzero] * query_norm)
+    return relevance
+
+
+def tf_matrix(engine, term_ids):
+    """
+    tf_matrix: CSR document x query-term matrix for every document containing at least one query term.
+    Returns: (sorted candidate document rows, csr matrix of shape (len(doc_rows), len(term_ids)))
+    """
+    doc_rows = engine.candidates(term_ids)
+    if len(term_ids) == 0:
+        return doc_rows, sparse.csr_matrix((0, 0), dtype=np.float64)
+
+    lists = [engine.postings(tid) for tid in term_ids]
+    cols = np.concatenate([np.full(len(p_docs), col, dtype=np.int32) for col, (p_docs, _) in enumerate(lists)])
+    rows = np.searchsorted(doc_rows, np.concatenate([p_docs for p_docs, _ in lists]))
+    data = np.concatenate([p_tfs for _, p_tfs in lists]).astype(np.float64)
+
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(doc_rows), len(term_ids)))
+    return doc_rows, matrix
+
+
+def score_documents(engine, term_ids, query_weights):
+    """
+    score_documents: rank every candidate document of a query in a handful of array operations.
+    Args:
+        engine: IndexEngine
+        term_ids: query term ids
+        query_weights: weight of each query term, aligned with term_ids
+
+    Returns: ScoredDocuments, every field aligned with doc_ids (candidates in document row order, unsorted).
+    """
+    if len(term_ids) == 0:
+        empty = np.empty(0, dtype=np.float64)
+        return ScoredDocuments(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), empty, empty, empty)
+
+    query_vector = np.asarray(query_weights, dtype=np.float64)
+    query_norm = np.linalg.norm(query_vector)
+    idf_vector = np.array([engine.idf(tid) for tid in term_ids])
+
+    doc_rows, tfs = tf_matrix(engine, term_ids)
+    tfidf = tfs @ sparse.diags(idf_vector)
+    relevance = _cosine(tfidf @ query_vector, engine.doc_norms[doc_rows], query_norm)
+
+    static, hits = static_scores(engine, doc_rows)
+    final = TFIDF_WEIGHT * relevance + static
+
+    return ScoredDocuments(doc_rows, engine.doc_ids[doc_rows], final, relevance, hits)
+
+
+def top_k(engine, term_ids, query_weights, k, allowed_rows=None):
+    """
+    top_k: the k best documents of a query, without scoring every candidate (MaxScore).
+
+    A document matching only the query terms in S scores at most
+        TFIDF_WEIGHT * min(sum of q_t * max impact_t / |q| over S, |q_S| / |q|) + max static score over S
+    where the max impact of a term (tf * idf / document norm) and its max static score are computed when the
+    index is loaded, and |q_S| / |q| is the Cauchy-Schwarz bound of the cosine. Terms are sorted by that bound,
+    and once the k-th best score (threshold) beats the bound of the weakest terms, their posting lists become
+    "non-essential": they are only probed for documents found in the essential lists.
+
+    Document rows are visited in blocks in descending static score order (see IndexEngine), the walk stops
+    entirely when even a perfect relevance on the next row cannot beat the threshold.
+
+    allowed_rows: optional sorted array of document rows, other documents are never returned (phrase queries)
+
+    Returns: ScoredDocuments of at most k documents, sorted by final score descending.
+    """
+    if len(term_ids) == 0 or k <= 0 or (allowed_rows is not None and len(allowed_rows) == 0):
+        return score_documents(engine, [], [])
+
+    query_vector = np.asarray(query_weights, dtype=np.float64)
+    query_norm = np.linalg.norm(query_vector)
+    idf_vector = np.array([engine.idf(tid) for tid in term_ids])
+
+    # Sort terms by their own bound, so that non-essential terms always form a prefix
+    impact_bounds = query_vector * np.array([engine.max_impact(tid) for tid in term_ids]) / query_norm
+    static_bounds = np.array([engine.static_bound(tid) for tid in term_ids])
+    term_order = np.argsort(TFIDF_WEIGHT * impact_bounds + static_bounds, kind='stable')
+    relevance_bounds = TFIDF_WEIGHT * np.minimum(
+        np.cumsum(impact_bounds[term_order]),
+        np.sqrt(np.cumsum(query_vector[term_order] ** 2)) / query_norm
+    )
+    static_prefix_bounds = np.maximum.accumulate(static_bounds[term_order])
+    lists = [engine.postings(term_ids[i])[0] for i in term_order]
+
+    best_rows = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float64)
+    best_relevance = np.empty(0, dtype=np.float64)
+    threshold = -np.inf
+
+    for block_start in range(0, engine.n_docs, TOP_K_BLOCK_SIZE):
+        if len(best_rows) == k and relevance_bounds[-1] + engine.static_scores[block_start] <= threshold:
+            break
+        block_end = min(block_start + TOP_K_BLOCK_SIZE, engine.n_docs)
+
+        # No document of this block has a higher static score than its first row
+        prefix_bounds = relevance_bounds + np.minimum(static_prefix_bounds, engine.static_scores[block_start])
+        n_non_essential = int(np.searchsorted(prefix_bounds, threshold, side='right'))
+        block_lists = []
+        for p_docs in lists[n_non_essential:]:
+            lo, hi = np.searchsorted(p_docs, [block_start, block_end])
+            block_lists.append(p_docs[lo:hi])
+        if not block_lists:
+            break
+        doc_rows = np.unique(np.concatenate(block_lists))
+        if allowed_rows is not None:
+            doc_rows = doc_rows[np.isin(doc_rows, allowed_rows, assume_unique=True)]
+        if len(doc_rows) == 0:
+            continue
+
+        tfidf = engine.tf_matrix(term_ids, doc_rows) * idf_vector
+        relevance = _cosine(tfidf @ query_vector, engine.doc_norms[doc_rows], query_norm)
+        final = TFIDF_WEIGHT * relevance + engine.static_scores[doc_rows]
+
+        best_rows = np.concatenate([best_rows, doc_rows])
+        best_scores = np.concatenate([best_scores, final])
+        best_relevance = np.concatenate([best_relevance, relevance])
+        if len(best_rows) > k:
+            keep = np.argpartition(-best_scores, k - 1)[:k]
+            best_rows, best_scores, best_relevance = best_rows[keep], best_scores[keep], best_relevance[keep]
+        if len(best_rows) == k:
+            threshold = best_scores.min()
+
+    # Ties are broken by document row, the same order score_documents produces
+    order = np.lexsort((best_rows, -best_scores))
+    best_rows = best_rows[order]
+    _, hits = static_scores(engine, best_rows)
+    return ScoredDocuments(best_rows, engine.doc_ids[best_rows], best_scores[order], best_relevance[order], hits)
+
+
+def boost_proximity(scored, spans, n_terms):
+    """
+    boost_proximity: add the proximity bonus and re-sort.
+    A document with m of the n query terms inside a window of w tokens gets PROXIMITY_WEIGHT * (m / n) * (m / w),
+    1.0 * PROXIMITY_WEIGHT when all terms are adjacent.
+    Args:
+        scored: ScoredDocuments sorted by final score
+        spans: a dictionary doc_id -> (m, w), see positional_index.proximity_spans
+        n_terms: number of distinct query terms
+
+    Returns: ScoredDocuments sorted by the boosted final score
+    """
+    bonus = np.array([
+        (spans[doc_id][0] / n_terms) * (spans[doc_id][0] / spans[doc_id][1]) if doc_id in spans else 0.0
+        for doc_id in scored.doc_ids.tolist()
+    ], dtype=np.float64).reshape(-1)
+    final = scored.final + PROXIMITY_WEIGHT * bonus
+    order = np.argsort(-final, kind='stable')
+    return ScoredDocuments(scored.doc_rows[order], scored.doc_ids[order], final[order],
+                           scored.relevance[order], scored.hits[order])
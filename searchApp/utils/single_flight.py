@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+# Description: Single-flight computation, one caller computes a value while the others wait to be notified
+# Note: Threads of a worker wait on an Event, workers wait on a Redis lock and a pub/sub channel.
+#       Without a Redis cache backend only the threads of each worker are coordinated.
+
+import threading
+import time
+import uuid
+
+from django_redis import get_redis_connection
+
+# Redis connection (cache alias) holding the locks and channels
+LOCK_CACHE = 'default'
+KEY_PREFIX = 'single_flight'
+# Seconds a lock outlives a computing worker that died
+LOCK_TIMEOUT = 30
+# Seconds a caller waits for another one before computing the value itself
+WAIT_TIMEOUT = 10
+# Seconds between checks that the lock holder is still alive
+LOCK_CHECK_INTERVAL = 1
+
+# Delete the lock only if it is still ours, it may have expired and been taken by another worker
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def run(key, load, compute, wait_timeout=WAIT_TIMEOUT):
+    """
+    run: get a value computed by exactly one caller across the threads and workers.
+    Args:
+        key: name of the computation, e.g. a cache key
+        load: returns the stored value, None if it is not stored yet
+        compute: computes and stores the value, then returns it
+        wait_timeout: seconds to wait for another caller before computing the value anyway
+
+    Returns: (value, True if the value was loaded instead of computed by this caller)
+    """
+    value = load()
+    if value is not None:
+        return value, True
+
+    with _flights_lock:
+        event = _flights.get(key)
+        leader = event is None
+        if leader:
+            event = _flights[key] = threading.Event()
+
+    if not leader:
+        event.wait(wait_timeout)
+        value = load()
+        if value is not None:
+            return value, True
+        # The computing thread failed or is too slow
+        return compute(), False
+
+    try:
+        return _run_across_workers(key, load, compute, wait_timeout)
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        event.set()
+
+
+def _run_across_workers(key, load, compute, wait_timeout):
+    try:
+        redis = get_redis_connection(LOCK_CACHE)
+    except NotImplementedError:
+        # Not a Redis cache backend
+        return compute(), False
+
+    lock_key = f'{KEY_PREFIX}:lock:{key}'
+    channel = f'{KEY_PREFIX}:done:{key}'
+    token = uuid.uuid4().hex
+
+    if redis.set(lock_key, token, nx=True, ex=LOCK_TIMEOUT):
+        try:
+            # Another worker may have stored it between our first look and the lock
+            value = load()
+            if value is not None:
+                return value, True
+            return compute(), False
+        finally:
+            redis.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+            redis.publish(channel, token)
+
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(channel)
+        # The holder may have finished before the subscription
+        value = load()
+        deadline = time.monotonic() + wait_timeout
+        while value is None and redis.exists(lock_key):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if pubsub.get_message(timeout=min(remaining, LOCK_CHECK_INTERVAL)) is not None:
+                break
+        if value is None:
+            value = load()
+    finally:
+        pubsub.close()
+
+    if value is not None:
+        return value, True
+    # The holder failed, died or is too slow
+    return compute(), False
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+# Description: Query-term highlighted excerpts cut from Document.content using stored positions
+# Note: Only the excerpt itself is read from MySQL, never the whole content field
+
+from collections import Counter
+
+from django.db.models import Case, When, TextField
+from django.db.models.functions import Substr
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from unidecode import unidecode
+
+from searchApp.models import Document, TokenOffsets
+from searchApp.utils.positional_index import fetch_positions, decode_positions
+
+# Window (in tokens) in which query term hits are counted
+SNIPPET_WINDOW = 30
+# Tokens shown before the first hit of the window, and in total
+SNIPPET_LEAD = 8
+SNIPPET_TOKENS = 40
+# Hard limit of characters read for an excerpt
+SNIPPET_MAX_CHARS = 400
+# Positions considered per term and document, bounds the time spent on one result
+SNIPPET_MAX_POSITIONS = 256
+
+
+def densest_window(term_positions, window=SNIPPET_WINDOW):
+    """
+    densest_window: the window of `window` tokens covering the most distinct query terms, then the most hits.
+    Args:
+        term_positions: a dictionary term_id -> ascending positions
+
+    Returns: first position of the best window, None if there is no hit
+
+    """
+    hits = sorted(
+        (position, term_id)
+        for term_id, positions in term_positions.items()
+        for position in positions[:SNIPPET_MAX_POSITIONS].tolist()
+    )
+    if not hits:
+        return None
+
+    best, best_start = (0, 0), hits[0][0]
+    in_window = Counter()
+    left = 0
+    for right, (position, term_id) in enumerate(hits):
+        in_window[term_id] += 1
+        while hits[left][0] <= position - window:
+            in_window[hits[left][1]] -= 1
+            if in_window[hits[left][1]] == 0:
+                del in_window[hits[left][1]]
+            left += 1
+        score = (len(in_window), right - left + 1)
+        if score > best:
+            best, best_start = score, hits[left][0]
+    return best_start
+
+
+def highlight(text, terms):
+    """
+    highlight: escape the excerpt and wrap words matching a query term in <mark>.
+    """
+    words = []
+    for word in text.split(' '):
+        tokens = unidecode(word).lower().split()
+        if any(token in terms for token in tokens):
+            words.append(f"<mark>{escape(word)}</mark>")
+        else:
+            words.append(escape(word))
+    return ' '.join(words)
+
+
+def make_snippets(doc_ids, terms, engine):
+    """
+    make_snippets: highlighted excerpts around the densest cluster of query terms, three queries in total.
+    Args:
+        doc_ids: list of document ids (one result page)
+        terms: query term strings
+        engine: IndexEngine, maps terms to term ids
+
+    Returns: a dictionary doc_id -> safe html excerpt, documents without any hit are left out
+
+    """
+    term_ids = [engine.term_id(term) for term in terms if engine.term_id(term) is not None]
+    if not doc_ids or not term_ids:
+        return {}
+
+    # Token range of each excerpt
+    token_ranges = {}
+    for doc_id, term_positions in fetch_positions(term_ids, doc_ids).items():
+        start = densest_window(term_positions)
+        if start is not None:
+            first = max(start - SNIPPET_LEAD, 1)
+            token_ranges[doc_id] = (first, first + SNIPPET_TOKENS)
+    if not token_ranges:
+        return {}
+
+    # Character range of each excerpt
+    char_ranges = {}
+    for doc_id, blob in TokenOffsets.objects.filter(document_id__in=token_ranges).values_list('document_id', 'offsets'):
+        offsets = decode_positions(blob)
+        first, last = token_ranges[doc_id]
+        if first > len(offsets):
+            continue
+        begin = int(offsets[first - 1])
+        end = int(offsets[last - 1]) if last <= len(offsets) else begin + SNIPPET_MAX_CHARS
+        char_ranges[doc_id] = (begin, min(end - begin, SNIPPET_MAX_CHARS), first > 1, last <= len(offsets))
+    if not char_ranges:
+        return {}
+
+    # Cut every excerpt inside MySQL
+    excerpts = Document.objects.filter(id__in=char_ranges).annotate(excerpt=Case(
+        *[When(id=doc_id, then=Substr('content', begin + 1, length))
+          for doc_id, (begin, length, _, _) in char_ranges.items()],
+        output_field=TextField(),
+    )).values_list('id', 'excerpt')
+
+    highlight_terms = set(terms)
+    snippets = {}
+    for doc_id, excerpt in excerpts:
+        _, _, cut_before, cut_after = char_ranges[doc_id]
+        html = highlight(excerpt.strip(), highlight_terms)
+        snippets[doc_id] = mark_safe(("... " if cut_before else "") + html + (" ..." if cut_after else ""))
+    return snippets
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+# Description: In-memory prefix index answering search suggestions without touching MySQL
+# Note: Built by scripts/suggestion_index.py, rebuild it after each crawl to suggest new terms (workers reload the file)
+
+import os
+import threading
+from bisect import bisect_left
+
+import joblib
+import numpy as np
+
+SUGGESTION_FILE = 'suggestion_index.pkl'
+SUGGESTIONS_PER_PREFIX = 6
+
+
+class SuggestionIndex:
+    """
+    terms: alphabetically sorted terms, so the terms starting with a prefix are one contiguous range
+    ranks: suggestion rank of every term (0 is the best: highest df, then highest average PageRank)
+    top: prefix -> best terms, precomputed for prefixes up to max_precomputed_prefix characters
+    """
+
+    def __init__(self, terms, ranks, top, max_precomputed_prefix):
+        self.terms = terms
+        self.ranks = ranks
+        self.top = top
+        self.max_precomputed_prefix = max_precomputed_prefix
+
+    def suggest(self, prefix, k=SUGGESTIONS_PER_PREFIX):
+        """
+        suggest: the best k terms starting with prefix, best first.
+        """
+        if len(prefix) <= self.max_precomputed_prefix and k <= SUGGESTIONS_PER_PREFIX:
+            return self.top.get(prefix, [])[:k]
+
+        lo = bisect_left(self.terms, prefix)
+        # Every term starting with the prefix sorts before prefix + the highest code point
+        hi = bisect_left(self.terms, prefix + '\U0010ffff', lo)
+        if hi - lo <= k:
+            best = lo + np.argsort(self.ranks[lo:hi])
+        else:
+            candidates = lo + np.argpartition(self.ranks[lo:hi], k - 1)[:k]
+            best = candidates[np.argsort(self.ranks[candidates])]
+        return [self.terms[i] for i in best.tolist()]
+
+
+# (modification time of the file, index)
+_index = (None, None)
+_index_lock = threading.Lock()
+
+
+def load_suggestion_index(path=SUGGESTION_FILE):
+    try:
+        data = joblib.load(path)
+    except FileNotFoundError:
+        return None
+    return SuggestionIndex(data['terms'], data['ranks'], data['top'], data['max_precomputed_prefix'])
+
+
+def get_suggestion_index(path=SUGGESTION_FILE):
+    """
+    get_suggestion_index: the index of this worker, loaded again whenever scripts/suggestion_index.py rewrites the
+    file. None if it has not been built.
+    """
+    global _index
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _index[0]:
+        with _index_lock:
+            if mtime != _index[0]:
+                _index = (mtime, load_suggestion_index(path))
+    return _index[1]
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+# Description: Two-tier cache, a bounded in-process LRU in front of a django-redis cache
+# Note: Local entries are dropped when the index generation changes, every worker forgets them after a re-crawl
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from searchApp.utils import index_generation
+
+# Bytes of serialized values each worker keeps in front of a cache, 0 reads and writes Redis only
+LOCAL_CACHE_BYTES = {
+    'search_results': 64 * 1024 * 1024,
+    'search_suggestions': 4 * 1024 * 1024,
+    'term_expansion': 4 * 1024 * 1024,
+    # Cards are dropped from Redis by the spider and desc_gen.py, a local copy would outlive that
+    'document_cards': 0,
+}
+DEFAULT_LOCAL_CACHE_BYTES = 8 * 1024 * 1024
+# Values larger than this share of a local tier are only kept in Redis
+MAX_ENTRY_SHARE = 0.05
+# Seconds a value read from Redis stays in the local tier (its remaining Redis timeout is not known)
+PROMOTED_TIMEOUT = 5 * 60
+
+
+class TieredCache:
+    """
+    entries: key -> (expiry as time.monotonic(), pickled value), least recently used first
+    size: total bytes of the pickled values
+    Values are kept pickled, which bounds the tier by real bytes and gives every caller its own copy.
+    """
+
+    def __init__(self, alias, max_bytes):
+        self.alias = alias
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.lock = threading.Lock()
+
+    @property
+    def remote(self):
+        return caches[self.alias]
+
+    def _check_generation(self):
+        generation = index_generation.current_generation()
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.size -= len(payload)
+                return None
+            self.entries.move_to_end(key)
+        return pickle.loads(payload)
+
+    def _set_local(self, key, value, timeout):
+        if not self.max_bytes:
+            return
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes * MAX_ENTRY_SHARE:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.entries[key] = (time.monotonic() + timeout, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, key, default=None):
+        self._check_generation()
+        value = self._get_local(key)
+        if value is not None:
+            return value
+        value = self.remote.get(key)
+        if value is None:
+            return default
+        self._set_local(key, value, PROMOTED_TIMEOUT)
+        return value
+
+    def set(self, key, value, timeout=PROMOTED_TIMEOUT):
+        self._check_generation()
+        self.remote.set(key, value, timeout=timeout)
+        self._set_local(key, value, timeout)
+
+    def get_many(self, keys, stats=None):
+        """
+        get_many: values of many keys, the ones missing locally are read with a single MGET.
+        Args:
+            keys: list of keys
+            stats: optional Counter, incremented with local_hits, remote_hits, misses and round_trips
+
+        Returns: a dictionary key -> value, missing keys are left out
+        """
+        self._check_generation()
+        found = {}
+        for key in keys:
+            value = self._get_local(key)
+            if value is not None:
+                found[key] = value
+        missing = [key for key in keys if key not in found]
+        remote = self.remote.get_many(missing) if missing else {}
+        for key, value in remote.items():
+            self._set_local(key, value, PROMOTED_TIMEOUT)
+        if stats is not None:
+            stats['local_hits'] += len(found)
+            stats['remote_hits'] += len(remote)
+            stats['misses'] += len(missing) - len(remote)
+            stats['round_trips'] += 1 if missing else 0
+        found.update(remote)
+        return found
+
+    def set_many(self, values, timeout=PROMOTED_TIMEOUT, stats=None):
+        """
+        set_many: store many values with a single pipeline.
+        """
+        self._check_generation()
+        if not values:
+            return
+        self.remote.set_many(values, timeout=timeout)
+        for key, value in values.items():
+            self._set_local(key, value, timeout)
+        if stats is not None:
+            stats['writes'] += len(values)
+            stats['round_trips'] += 1
+
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+def get_cache(alias):
+    """
+    get_cache: the two-tier cache of a django-redis cache alias, shared by the threads of a worker.
+    """
+    tier = _tiers.get(alias)
+    if tier is None:
+        with _tiers_lock:
+            tier = _tiers.get(alias)
+            if tier is None:
+                tier = _tiers[alias] = TieredCache(alias, LOCAL_CACHE_BYTES.get(alias, DEFAULT_LOCAL_CACHE_BYTES))
+    return tier
@@ -1,73 +1,157 @@
 # -*- coding:utf-8 -*-　
 # Last modify: Liu Wentao
 # Description: Vague search based on semantic expansion
-# Note:
+# Note: The encoder, the cluster centroids and the term embeddings are loaded once per worker (see warm_up),
+#       everything but the encoder is loaded again when scripts/clustering.py publishes a new clustering
 
 
-from django.db.models import Sum, Q
-from searchApp.models import Term, TermCluster, InvertedIndex
-from sentence_transformers import SentenceTransformer
-import joblib
+import os
+import threading
+from collections import defaultdict, namedtuple
+
 import numpy as np
-import hdbscan
+from django.db import transaction
+
+from searchApp.models import Term, TermCluster, ClusterExpansion
+from searchApp.utils.embedding_store import load_term_embeddings, EMBEDDINGS_DIR, MANIFEST_FILE
+from searchApp.utils.ann_index import load_ann_index
+from searchApp.utils.cluster_centroids import load_cluster_centroids
+from searchApp.utils.query_encoder import BatchingEncoder
+from sentence_transformers import SentenceTransformer
+
+MODEL_CACHE = 'model_cache/'
+# Terms added to the query per expanded term
+EXPANSION_PER_TERM = 3
+
+# encoder: BatchingEncoder around the sentence transformer, returns unit-norm embeddings
+# neighbours: nearest-term search, the ANN index or the brute-force embedding store when the index is missing or stale
+# centroids: CentroidAssigner, None when the centroids are missing or stale
+# cluster_terms, term_clusters: expansion terms and cluster labels, read together (labels change with every run)
+VagueModels = namedtuple('VagueModels', ['encoder', 'neighbours', 'centroids', 'cluster_terms', 'term_clusters'])
+
+# (modification time of the embeddings manifest, VagueModels)
+_models = (None, None)
+_models_lock = threading.Lock()
+
+
+class TermClusters:
+    """
+    term_ids: sorted ids of the clustered terms
+    labels: TermCluster.cluster of every term, aligned with term_ids
+    """
+
+    def __init__(self, term_ids, labels):
+        self.term_ids = term_ids
+        self.labels = labels
+
+    def get(self, term_id):
+        row = int(np.searchsorted(self.term_ids, term_id))
+        if row < len(self.term_ids) and self.term_ids[row] == term_id:
+            return int(self.labels[row])
+        return None
+
+
+def load_cluster_expansion():
+    """
+    load_cluster_expansion: cluster -> its top terms by total tf, best first (see scripts/clustering.py).
+    """
+    cluster_terms = defaultdict(list)
+    rows = ClusterExpansion.objects.order_by('cluster', 'rank').values_list('cluster', 'term__term')
+    for cluster, term in rows:
+        cluster_terms[cluster].append(term)
+    return dict(cluster_terms)
+
+
+def load_term_clusters():
+    """
+    load_term_clusters: the cluster label of every term.
+    """
+    rows = np.array(list(TermCluster.objects.order_by('term_id').values_list('term_id', 'cluster')),
+                    dtype=np.int64).reshape(-1, 2)
+    return TermClusters(rows[:, 0], rows[:, 1])
+
+
+def get_models():
+    """
+    get_models: the VagueModels of this worker, loaded on first use and again when the embeddings manifest is
+    replaced by scripts/clustering.py (the encoder is kept).
+    Raises FileNotFoundError if scripts/clustering.py has not been run.
+    """
+    global _models
+    mtime = os.stat(os.path.join(EMBEDDINGS_DIR, MANIFEST_FILE)).st_mtime_ns
+    if mtime != _models[0]:
+        with _models_lock:
+            if mtime != _models[0]:
+                previous = _models[1]
+                embeddings = load_term_embeddings()
+                # One snapshot, the clustering script rewrites both tables in a single transaction
+                with transaction.atomic():
+                    cluster_terms = load_cluster_expansion()
+                    term_clusters = load_term_clusters()
+                _models = (mtime, VagueModels(
+                    encoder=previous.encoder if previous else BatchingEncoder(SentenceTransformer(MODEL_CACHE)),
+                    neighbours=load_ann_index(embeddings) or embeddings,
+                    centroids=load_cluster_centroids(embeddings),
+                    cluster_terms=cluster_terms,
+                    term_clusters=term_clusters,
+                ))
+    return _models[1]
+
+
+def warm_up():
+    """
+    warm_up: load the models before the first vague search, called by the WSGI / ASGI entry points.
+    """
+    try:
+        get_models()
+    except FileNotFoundError:
+        # Vague search stays disabled until the clustering script is run
+        pass
 
 
 def expand_terms(term_list):
     expanded_terms = []
 
     try:
-        # Load models once
-        model = SentenceTransformer('model_cache/')
-        clusterer = joblib.load('hdbscan_model.pkl')
-
-        # Preload all terms and embeddings for noise handling
-        all_terms = list(Term.objects.values_list('id', 'term'))
-        all_term_texts = [t[1] for t in all_terms]
-        all_embeddings = model.encode(all_term_texts) if all_terms else []
-
-        # Get existing terms in batch
-        existing_terms = Term.objects.filter(term__in=term_list)
-        term_clusters = {
-            t.term: t.termcluster.cluster
-            for t in existing_terms.select_related('termcluster')
-        }
+        models = get_models()
+
+        # Get existing terms in batch, their clusters come from the same clustering run as the expansions
+        existing_terms = Term.objects.filter(term__in=term_list).values_list('term', 'id')
+        term_clusters = {term: models.term_clusters.get(term_id) for term, term_id in existing_terms}
+
+        # Encode all new terms at once
+        new_terms = [term for term in term_list if term_clusters.get(term) is None]
+        new_embeddings = dict(zip(new_terms, models.encoder.encode(new_terms))) if new_terms else {}
 
         for term in term_list:
             cluster = term_clusters.get(term)
 
-            if not cluster:
+            if cluster is None:
                 # Handle new term
-                query_embedding = model.encode([term])[0]
-                query_embedding = query_embedding / np.linalg.norm(query_embedding)
-
-                # Predict cluster
-                cluster, _ = hdbscan.approximate_predict(clusterer, query_embedding.reshape(1, -1))
-                cluster = int(cluster[0])
-
-                # Handle noise
-                if cluster == -1 and all_embeddings.any():
-                    similarities = np.dot(all_embeddings, query_embedding)
-                    nearest_idx = np.argmax(similarities)
-                    cluster = TermCluster.objects.get(
-                        term_id=all_terms[nearest_idx][0]
-                    ).cluster
-
-            if cluster and cluster != -1:
+                query_embedding = new_embeddings[term]
+
+                # Predict cluster by the nearest centroid
+                if models.centroids is not None:
+                    cluster = models.centroids.assign(query_embedding)
+
+                # Handle noise (far from every centroid): use the cluster of the nearest term
+                if cluster is None and len(models.neighbours):
+                    nearest_term_id, _ = models.neighbours.nearest(query_embedding)
+                    cluster = models.term_clusters.get(nearest_term_id)
+
+            if cluster is not None and cluster != -1:
                 # Get top terms in cluster
-                related = InvertedIndex.objects.filter(
-                    term__termcluster__cluster=cluster
-                ).exclude(
-                    Q(term__term=term) | Q(term__term__in=expanded_terms)
-                ).values('term__term').annotate(
-                    total_tf=Sum('tf')
-                ).order_by('-total_tf')[:3]
+                related = [
+                    t for t in models.cluster_terms.get(cluster, [])
+                    if t != term and t not in expanded_terms
+                ][:EXPANSION_PER_TERM]
 
                 expanded_terms.append(term)
-                expanded_terms.extend([t['term__term'] for t in related])
+                expanded_terms.extend(related)
             else:
                 expanded_terms.append(term)
 
-    except (FileNotFoundError, TermCluster.DoesNotExist):
+    except FileNotFoundError:
         return term_list
 
     return list(dict.fromkeys(expanded_terms))
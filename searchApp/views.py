@@ -1,11 +1,9 @@
-import json
 import os
+import re
 import time
-from collections import defaultdict
-from urllib.parse import urlparse
 
 import numpy as np
-from django.core.cache import caches
+from django.conf import settings
 from django.core.paginator import Paginator
 from django.db.models import Avg
 from django.http import JsonResponse
@@ -13,76 +11,38 @@ from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.utils.html import escape
 from django.views.decorators.http import require_GET
-from lemminflect import getAllLemmas, getInflection
 
 from searchApp.utils import *
-from .models import Document, UrlLinkage, InvertedIndex, Term
+from .models import Document, Term
 
-# Cache instances
-search_results_cache = caches['search_results']
-search_suggestions_cache = caches['search_suggestions']
-term_expansion_cache = caches['term_expansion']
+# Cache instances, hot entries are also kept in this worker
+search_suggestions_cache = tiered_cache.get_cache('search_suggestions')
 
+# Number of ranked documents kept for a search, pages beyond it are not reachable
+SEARCH_TOP_K = 1000
+# Default and maximum number of results rendered on one page
+RESULTS_PAGE_SIZE = 10
+MAX_RESULTS_PAGE_SIZE = 50
+# Number of top documents re-ranked by query term proximity
+PROXIMITY_RERANK_DEPTH = 100
 
-# Generate display url
-def process_url(url):
-    parsed = urlparse(url)
-    domain = parsed.netloc
-    path = parsed.path.lstrip('/')
-    parts = path.split('/')
-    if parts:
-        last_part = parts[-1]
-        filename, ext = os.path.splitext(last_part)
-        parts[-1] = filename
 
-    result = f"{parsed.scheme}://{domain} > " + ' > '.join(parts)
-    return result
-
-
-def expand_query_term(term):
-    expanded_terms = set()
-    expanded_terms.add(term.lower())
-
-    lemmas = getAllLemmas(term)
-
-    for pos in lemmas:
-        for lemma in lemmas[pos]:
-            if pos == 'NOUN':
-                plural = getInflection(lemma, 'NNS')
-                if plural:
-                    expanded_terms.add(plural[0].lower())
-
-            elif pos == 'VERB':
-                forms = getInflection(lemma, 'VBG')  # Gerund (filming)
-                if forms: expanded_terms.update([f.lower() for f in forms])
-
-                forms = getInflection(lemma, 'VBD')  # Past tense (filmed)
-                if forms: expanded_terms.update([f.lower() for f in forms])
-
-                forms = getInflection(lemma, 'VBN')  # Past participle (filmed)
-                if forms: expanded_terms.update([f.lower() for f in forms])
-
-                forms = getInflection(lemma, 'VBZ')  # 3rd person singular (films)
-                if forms: expanded_terms.update([f.lower() for f in forms])
-
-    return list(expanded_terms)
+def split_query(query):
+    """
+    split_query: lower-cased words of a query, and its quoted phrases (each a list of words).
+    """
+    phrases = [phrase.lower().split() for phrase in re.findall(r'"([^"]+)"', query)]
+    words = query.replace('"', ' ').lower().split()
+    return words, [phrase for phrase in phrases if phrase]
 
 
 def process_query(query):
-    terms = query.strip().split()
-    if not terms:
+    lower_terms, _ = split_query(query)
+    if not lower_terms:
         return []
 
-    lower_terms = [term.lower() for term in terms]
-
-    all_expanded_terms = set()
-    for term in lower_terms:
-        expanded_terms = expand_query_term(term)
-        all_expanded_terms.update(expanded_terms)
-
-    existing_terms = Term.objects.filter(term__in=list(all_expanded_terms))
-
-    return list(existing_terms)
+    # Dictionary lookups over the in-memory vocabulary, no database round-trip
+    return morphology.expand_words(lower_terms, index_engine.get_engine())
 
 
 def search_page(request):
@@ -93,6 +53,17 @@ def search_page(request):
 def search_suggestions(request):
     query = request.GET.get('q', '').strip().lower()
 
+    # Answer from the configured suggestion structure when it has been built
+    suggestions = None
+    if settings.SUGGESTION_BACKEND == 'redis':
+        suggestions = autocomplete.suggest(query) if query else []
+    elif settings.SUGGESTION_BACKEND == 'index':
+        index = suggestion_index.get_suggestion_index()
+        if index is not None:
+            suggestions = index.suggest(query) if query else []
+    if suggestions is not None:
+        return JsonResponse({'suggestions': [escape(suggestion) for suggestion in suggestions]})
+
     # Try to get suggestions from cache
     cache_key = f'suggestions_{query}'
     cached_suggestions = search_suggestions_cache.get(cache_key)
@@ -122,212 +93,250 @@ def search_suggestions(request):
     return JsonResponse({'suggestions': suggestions})
 
 
-def search_results(request):
-    query = request.GET.get('q', '')
-    start = time.perf_counter()
+def rank_query(query, batch):
+    """
+    rank_query: rank the documents of a query, without loading any of them.
+    Args:
+        query: raw query string
+        batch: cache_batch.CacheBatch of the request, holds the term expansion cache accesses
+
+    Returns: a dictionary, 'ranking' is a result_cache.RANKING_DTYPE array of (doc_id, final score, relevance score,
+    HITS score) rows sorted by final score, 'result_count' is the number of matching documents (the ranking holds at
+    most SEARCH_TOP_K of them).
+    """
     vague_search = False
-    pages = []
-
-    # try to get result from cache
-    cache_key = f'search_results_{query}'
-    cached_results = search_results_cache.get(cache_key)
-
-    if cached_results is not None:
-        context = json.loads(cached_results)
-        context['time_consumption'] = f"{time.perf_counter() - start:.4f}"
-        context['cache_hit'] = True
-        return render(request, 'search_results.html', context)
-
+    words, phrases = split_query(query)
     search_query = process_query(query)
 
+    # Misspelled words are corrected to the closest indexed terms before trying the semantic expansion
+    corrected_query = []
+    if len(search_query) == 0 and words:
+        engine = index_engine.get_engine()
+        corrected_words, changed = fuzzy_index.correct_words(words, engine)
+        if changed:
+            search_query = morphology.expand_words(corrected_words, engine)
+            if search_query:
+                corrected_query = corrected_words
+                words = corrected_words
+
     expanded_query = []
-    if len(search_query) == 0:
+    if len(search_query) == 0 and words:
 
-        # try to get expanded terms from cache
-        term_cache_key = f'term_expansion_{query}'
-        cached_expanded_terms = term_expansion_cache.get(term_cache_key)
+        # try to get expanded terms from cache, they depend on the vocabulary of the index generation
+        term_cache_key = f'term_expansion_{index_engine.get_engine().generation}_{" ".join(sorted(set(words)))}'
+        expanded_terms = batch.get('term_expansion', term_cache_key)
 
-        if cached_expanded_terms is not None:
-            existing_expanded_terms = cached_expanded_terms
-        else:
-            existing_expanded_terms = Term.objects.filter(term__in=vague_searcher.expand_terms(query))
-            expanded_query = vague_searcher.expand_terms([query])
+        if expanded_terms is None:
+            expanded_terms = vague_searcher.expand_terms(words)
             # Cache the expanded terms
-            term_expansion_cache.set(term_cache_key, expanded_query, timeout=60 * 60)
+            batch.set('term_expansion', term_cache_key, expanded_terms, 60 * 60)
 
         vague_search = True
-        search_query = list(set(search_query + list(existing_expanded_terms)))
+        search_query = list(Term.objects.filter(term__in=expanded_terms))
         expanded_query = [q.term for q in search_query]
 
-    raw_docs = Document.objects.filter(invertedindex__term__in=search_query).distinct()
+    engine = index_engine.get_engine()
 
     # Relevance score calculation (core)
     # Calculate query term vector
     # Magic number: 1.0 for terms from origin query, 0.8 for terms from expansion
-    original_query_term_strs = set([term.lower() for term in query.strip().split()])
+    original_query_term_strs = set(words)
     term_id_to_weight = {
         term.id: (1.0 if term.term in original_query_term_strs else 0.8)
         for term in search_query
     }
 
     query_term_ids = list(term_id_to_weight.keys())
-    query_vector = np.array([term_id_to_weight[tid] for tid in query_term_ids])
-    query_norm = np.linalg.norm(query_vector)
-
-    # Collect terms idf vector
-    total_docs = Document.objects.count()
-    term_dfs = {term.id: term.df for term in search_query}
-    idf_vector = np.array([
-        np.log((total_docs + 1) / (term_dfs[tid] + 1)) + 1  # smooth
-        for tid in query_term_ids
-    ])
-
-    # Collect tf for all doc-term pairs
-    inv_indexes = InvertedIndex.objects.filter(
-        term_id__in=query_term_ids, document__in=raw_docs
-    ).values('document_id', 'term_id', 'tf')
-
-    # Map doc_id to vector
-    doc_vectors = defaultdict(lambda: np.zeros(len(query_term_ids)))
-
-    term_index = {tid: i for i, tid in enumerate(query_term_ids)}
-
-    for entry in inv_indexes:
-        doc_id = entry['document_id']
-        tid = entry['term_id']
-        tf = entry['tf']
-        idx = term_index[tid]
-        doc_vectors[doc_id][idx] = tf
-
-    # Calculate ranking score
-    # Magic number: compute final ranking score as 0.7 * tf/idf + 0.2 * pagerank + 0.1 * HITS
-    # TODO: Fine-tune Weight Params
-    scores = {}
-    relevance_scores = {}
-    hits_scores = {}
-    for doc in raw_docs:
-        doc_vec_raw = doc_vectors[doc.id]
-        doc_tfidf_vec = doc_vec_raw * idf_vector
-        doc_norm = np.linalg.norm(doc_tfidf_vec)
-
-        tfidf_score = np.dot(doc_tfidf_vec, query_vector) / (doc_norm * query_norm) if doc_norm != 0 else 0.0
-        hits_score = (doc.authority_score + doc.hub_score) / 2.0
-
-        final_score = (
-                0.7 * tfidf_score +
-                0.2 * doc.pr_score +
-                0.1 * hits_score
+    query_weights = [term_id_to_weight[tid] for tid in query_term_ids]
+
+    # Quoted phrases restrict the candidates to documents containing the exact phrase
+    allowed_rows = None
+    if phrases:
+        allowed_rows = positional_index.phrase_documents(
+            engine, [[engine.term_id(word) for word in phrase] for phrase in phrases]
         )
 
-        hits_scores[doc.id] = hits_score
-        relevance_scores[doc.id] = tfidf_score
-        scores[doc.id] = final_score
+    # Calculate ranking score, documents beyond the top SEARCH_TOP_K are skipped
+    scored = scoring.top_k(engine, query_term_ids, query_weights, SEARCH_TOP_K, allowed_rows=allowed_rows)
+
+    # Matching documents are only counted when the ranking is cut at SEARCH_TOP_K
+    result_count = len(scored.doc_ids)
+    if result_count == SEARCH_TOP_K:
+        candidates = engine.candidates(query_term_ids)
+        if allowed_rows is not None:
+            candidates = candidates[np.isin(candidates, allowed_rows)]
+        result_count = len(candidates)
+
+    # Re-rank the head of the ranking by how close the original query terms appear
+    proximity_term_ids = list(dict.fromkeys(
+        engine.term_id(word) for word in words if engine.term_id(word) is not None
+    ))
+    if len(proximity_term_ids) > 1 and len(scored.doc_ids):
+        head = min(PROXIMITY_RERANK_DEPTH, len(scored.doc_ids))
+        spans = positional_index.proximity_spans(proximity_term_ids, scored.doc_ids[:head].tolist())
+        boosted = scoring.boost_proximity(scoring.ScoredDocuments(*(field[:head] for field in scored)),
+                                          spans, len(proximity_term_ids))
+        scored = scoring.ScoredDocuments(*(
+            np.concatenate([boosted_field, field[head:]]) for boosted_field, field in zip(boosted, scored)
+        ))
+    ranking = np.empty(len(scored.doc_ids), dtype=result_cache.RANKING_DTYPE)
+    ranking['doc_id'] = scored.doc_ids
+    ranking['final'] = scored.final
+    ranking['relevance'] = scored.relevance
+    ranking['hits'] = scored.hits
+
+    return {
+        'query': query,
+        'vague_search': vague_search,
+        'expanded_query': expanded_query,
+        'corrected_query': corrected_query,
+        'query_terms': [term.term for term in search_query],
+        'ranking': ranking,
+        'result_count': result_count,
+    }
 
-    # Document ranking
-    doc_list = sorted(raw_docs, key=lambda d: scores.get(d.id, 0), reverse=True)
 
-    # Show docs
-    for doc in doc_list:
-        links = UrlLinkage.objects.filter(to_document_id=doc.id).select_related('from_document')
-        from_docs = []
-        for link in links:
-            from_docs.append({
-                'url': link.from_document.url,
-                'title': link.from_document.title,
-            })
-
-        links = UrlLinkage.objects.filter(from_document_id=doc.id).select_related('to_document')
-        to_docs = []
-        for link in links:
-            to_docs.append({
-                'url': link.to_document.url,
-                'title': link.to_document.title,
-            })
-
-        keywords_db = InvertedIndex.objects.filter(document_id=doc.id).select_related('term').order_by(
-            '-tf').values_list(
-            'term__term', flat=True)[:5]
-
-        keywords = [keyword for keyword in keywords_db]
-
-        # GENAI label judgement
-        description_ai = False
-        description = doc.description
-        if description.split("`")[-1] == "AIDESC":
-            description_ai = True
-            description = "`".join(description.split("`")[:-1])
+def cached_rank_query(query, batch):
+    """
+    cached_rank_query: rank_query() through the search result cache. Concurrent requests for the same query
+    (results page, AI analysis, other workers) wait for the one computing it instead of ranking it again.
+    Args:
+        query: raw query string
+        batch: cache_batch.CacheBatch of the request
+
+    Returns: (rank_query() result, True if it came from the cache or another request)
+    """
+    # Every page and every spelling of a query share one ranking.
+    # Rankings are cached under the generation of the index that computed them, a re-crawl starts afresh
+    words, phrases = split_query(query)
+    engine = index_engine.get_engine(index_generation.current_generation())
+    cache_key = result_cache.ranking_key(engine.generation, words, phrases)
+
+    def compute():
+        ranked = rank_query(query, batch)
+        result_cache.set_ranking(cache_key, ranked, batch)
+        # Stored before the waiting requests are notified
+        batch.flush()
+        return ranked
+
+    return single_flight.run(cache_key, lambda: result_cache.get_ranking(cache_key, batch), compute)
+
+
+def compose_pages(ranking, query_terms, batch):
+    """
+    compose_pages: load and compose the rows (pages) of a slice of a ranking.
+    Args:
+        ranking: list of (doc_id, final score, relevance score, HITS score)
+        query_terms: term strings highlighted in the excerpts
+        batch: cache_batch.CacheBatch of the request, holds the result cards
+    """
+    ranked_ids = [row[0] for row in ranking]
+    raw_docs = Document.objects.defer('content').in_bulk(ranked_ids)
+    cards = document_cards.get_cards(list(raw_docs.values()), batch)
+    excerpts = snippets.make_snippets(ranked_ids, query_terms, index_engine.get_engine())
+
+    pages = []
+    for doc_id, final_score, relevance_score, hits_score in ranking:
+        doc = raw_docs.get(doc_id)
+        if doc is None:
+            continue
+        card = cards[doc.id]
 
         # Compose a row (page)
         pages.append({
             'id': doc.id,
             'title': doc.title,
-            'display_url': process_url(doc.url),
+            'display_url': card['display_url'],
             'url': doc.url,
-            'snippet': description,
-            'desc_ai': description_ai,
+            'snippet': card['snippet'],
+            'desc_ai': card['desc_ai'],
+            'excerpt': excerpts.get(doc.id),
             'last_modify': str(doc.last_modify),
             'size': doc.page_size,
-            'keywords': keywords,
-            'from_docs': from_docs,
-            'to_docs': to_docs,
-            'relevance_score': f"R: {round(relevance_scores.get(doc.id, 0), 4)}",
-            'hits_score': f"H: {round(hits_scores.get(doc.id, 0), 4)}",
+            'keywords': card['keywords'],
+            'from_docs': card['from_docs'],
+            'to_docs': card['to_docs'],
+            'relevance_score': f"R: {round(relevance_score, 4)}",
+            'hits_score': f"H: {round(hits_score, 4)}",
             'pr_score': f"P: {round(doc.pr_score, 4)}",
-            'final_score': f"Score: {round(scores.get(doc.id, 0), 4)}",
+            'final_score': f"Score: {round(final_score, 4)}",
         })
 
+    return pages
+
+
+def compact_page_range(page_obj):
+    # 生成智能页码范围（前后各显示2页）
+    page_range = []
+    for num in page_obj.paginator.page_range:
+        if num <= 2 or \
+                num >= page_obj.paginator.num_pages - 1 or \
+                abs(num - page_obj.number) <= 2:
+            page_range.append(num)
+        elif page_range[-1] != '...':
+            page_range.append('...')
+    return page_range
+
+
+def search_results(request):
+    query = request.GET.get('q', '')
+    start = time.perf_counter()
+
+    try:
+        page_size = min(max(int(request.GET.get('size', RESULTS_PAGE_SIZE)), 1), MAX_RESULTS_PAGE_SIZE)
+    except ValueError:
+        page_size = RESULTS_PAGE_SIZE
+
+    # Cache reads of this request are batched per Redis db, writes are flushed together
+    batch = cache_batch.CacheBatch()
+    ranked, cache_hit = cached_rank_query(query, batch)
+
+    # Only the requested page is loaded and rendered
+    paginator = Paginator(ranked['ranking'], page_size)
+    page_obj = paginator.get_page(request.GET.get('page', 1))
+    pages = compose_pages(page_obj.object_list.tolist(), ranked['query_terms'], batch)
+
     end = time.perf_counter()
 
     context = {
         'query': query,
-        'vague_search': vague_search,
-        'expanded_query': expanded_query,
+        'vague_search': ranked['vague_search'],
+        'expanded_query': ranked['expanded_query'],
+        'corrected_query': ranked['corrected_query'],
         'time_consumption': f"{end - start:.4f}",
         'pages': pages,
-        'cache_hit': False,
+        # Rankings cached before the count was stored only know their own length
+        'result_count': ranked.get('result_count', paginator.count),
+        'page_number': page_obj.number,
+        'pages_count': paginator.num_pages,
+        'page_range': compact_page_range(page_obj),
+        'page_size': page_size,
+        'cache_hit': cache_hit,
     }
 
-    save_context = {
-        'query': query,
-        'pages': pages,
-    }
-    # print(save_context)
-
-    # Cache the search results
-    search_results_cache.set(cache_key, json.dumps(save_context), timeout=60 * 60)
-
-    return render(request, 'search_results.html', context)
+    response = render(request, 'search_results.html', context)
+    batch.close()
+    response['X-Cache-Batch'] = batch.summary()
+    return response
 
 
 def ai_analysis(request):
     query = request.GET.get('q', '')
 
-    # try to get result from cache
-    cache_key = f'search_results_{query}'
-    cached_results = search_results_cache.get(cache_key)
-
-    # Try 3 times
-    attempt_times = 3
+    # Shares the ranking of the results page, waiting for it if that request is still computing it
+    batch = cache_batch.CacheBatch()
+    ranked, _ = cached_rank_query(query, batch)
+    batch.close()
 
-    while cached_results is None and attempt_times > 0:
-        time.sleep(1)
-        print(f"Try {4 - attempt_times} to fetch search result from redis")
-        cached_results = search_results_cache.get(cache_key)
+    # Use top 5 results
+    top_docs = 5
 
     documents = ""
-    if cached_results is not None:
-        # Use top 5 results
-        top_docs = 5
-
-        context = json.loads(cached_results)
-        pages = context["pages"]
+    top_ids = ranked["ranking"]['doc_id'][:top_docs].tolist()
+    contents = dict(Document.objects.filter(id__in=top_ids).values_list('id', 'content'))
 
-        for index, doc in enumerate(pages):
-            if top_docs <= 0:
-                break
-            document = Document.objects.get(id=doc["id"]).content
-            documents += f"Document {index}: {document}\n"
-            top_docs -= 1
+    for index, doc_id in enumerate(top_ids):
+        documents += f"Document {index}: {contents.get(doc_id, '')}\n"
 
     prompt = f"""
     {aliyun_helper.PROMPT_TEMPLATE}
@@ -335,7 +344,9 @@ def ai_analysis(request):
     Documents: {documents}
     """
 
-    return StreamingHttpResponse(aliyun_helper.chat_complete_stream(prompt))
+    response = StreamingHttpResponse(aliyun_helper.chat_complete_stream(prompt))
+    response['X-Cache-Batch'] = batch.summary()
+    return response
 
 
 def pages(request, page_number=1):
@@ -346,58 +357,28 @@ def pages(request, page_number=1):
     pages_count = paginator.num_pages
     page_obj = paginator.get_page(page_number)
 
-    # 生成智能页码范围（前后各显示2页）
-    page_range = []
-    for num in page_obj.paginator.page_range:
-        if num <= 2 or \
-                num >= page_obj.paginator.num_pages - 1 or \
-                abs(num - page_obj.number) <= 2:
-            page_range.append(num)
-        elif page_range[-1] != '...':
-            page_range.append('...')
+    page_range = compact_page_range(page_obj)
 
     doc_list = paginator.page(page_number)
     pages = []
 
+    batch = cache_batch.CacheBatch()
+    cards = document_cards.get_cards(list(doc_list), batch)
     for doc in doc_list:
-
-        links = UrlLinkage.objects.filter(to_document_id=doc.id).select_related('from_document')
-        from_docs = []
-        for link in links:
-            from_docs.append({
-                'url': link.from_document.url,
-                'title': link.from_document.title,
-            })
-
-        links = UrlLinkage.objects.filter(from_document_id=doc.id).select_related('to_document')
-        to_docs = []
-        for link in links:
-            to_docs.append({
-                'url': link.to_document.url,
-                'title': link.to_document.title,
-            })
-
-        keywords = InvertedIndex.objects.filter(document_id=doc.id).select_related('term').order_by('-tf').values_list(
-            'term__term', flat=True)[:5]
-
-        description_ai = False
-        description = doc.description
-        if description.split("`")[-1] == "AIDESC":
-            description_ai = True
-            description = "`".join(description.split("`")[:-1])
+        card = cards[doc.id]
 
         pages.append({
             'id': doc.id,
             'title': doc.title,
-            'display_url': process_url(doc.url),
+            'display_url': card['display_url'],
             'url': doc.url,
-            'snippet': description,
-            'desc_ai': description_ai,
+            'snippet': card['snippet'],
+            'desc_ai': card['desc_ai'],
             'last_modify': doc.last_modify,
             'size': doc.page_size,
-            'keywords': keywords,
-            'from_docs': from_docs,
-            'to_docs': to_docs,
+            'keywords': card['keywords'],
+            'from_docs': card['from_docs'],
+            'to_docs': card['to_docs'],
             'score': f"Pagerank: {round(doc.pr_score, 4)}"
         })
 
@@ -409,4 +390,16 @@ def pages(request, page_number=1):
         'pages': pages,
     }
 
-    return render(request, 'pages.html', context)
+    response = render(request, 'pages.html', context)
+    batch.close()
+    response['X-Cache-Batch'] = batch.summary()
+    return response
+
+
+@require_GET
+def cache_stats(request):
+    """
+    cache_stats: cache counters of every request this worker served since it started (see cache_batch.totals),
+    the pid tells the workers apart.
+    """
+    return JsonResponse({'pid': os.getpid(), 'totals': cache_batch.totals()})